@@ -1,7 +1,16 @@
+import bisect
+import asyncio
+import functools
+import itertools
+import math
+import multiprocessing
+import queue
 import random
+import time
 from abc import ABC, abstractmethod
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
 from dataclasses import dataclass
-from typing import Generator, Sequence
+from typing import AsyncGenerator, Callable, Generator, Iterable, Sequence
 
 
 class Value(ABC):
@@ -35,6 +44,102 @@ class Value(ABC):
         """
         pass
 
+    def compile(self, slots: dict["Variable", int]) -> Callable[[list[int]], int]:
+        """
+        Compile this value into a plain function of a slot array.
+
+        Args:
+            slots: Dictionary mapping each Variable to its index in the slot array.
+
+        Returns:
+            Function taking a list of variable values, indexed by slot, and
+            returning the evaluated integer result.
+        """
+        namespace: dict = {}
+        return _compile_source(self._source(slots, namespace), namespace)
+
+    def _source(self, slots: dict["Variable", int], namespace: dict) -> str:
+        """
+        Return a Python expression over the slot array `s` that evaluates this
+        value. Subclasses without a specialised expression fall back to
+        calling evaluate() with a bindings dict built from the slot array.
+        """
+        variables = self.variables()
+
+        def evaluate(s: list[int]) -> int:
+            return self.evaluate({v: s[slots[v]] for v in variables})
+
+        namespace["_scalar_only"] = True
+        return f"{_register(namespace, evaluate)}(s)"
+
+    def bounds(
+        self, domains: dict["Variable", Sequence[int]]
+    ) -> tuple[int, int] | None:
+        """
+        Compute the smallest and largest values this expression can take.
+
+        Args:
+            domains: Dictionary mapping Variable objects to their possible values.
+
+        Returns:
+            (lowest, highest) pair, or None if the bounds are unknown.
+        """
+        return None
+
+    def narrow(
+        self, lo: float, hi: float, domains: dict["Variable", Sequence[int]]
+    ) -> bool:
+        """
+        Remove values that cannot make this expression lie in [lo, hi] from
+        the domains of its variables. Narrowed domains are replaced in the
+        dictionary; the original sequences are never modified.
+
+        Args:
+            lo: Lowest allowed value (may be -inf).
+            hi: Highest allowed value (may be inf).
+            domains: Dictionary mapping Variable objects to their possible values.
+
+        Returns:
+            False if the expression can no longer lie in [lo, hi], True otherwise.
+        """
+        return True
+
+    def residues(
+        self, modulus: int, domains: dict["Variable", Sequence[int]]
+    ) -> set[int] | None:
+        """
+        Compute the remainders this expression can leave when divided by
+        `modulus`.
+
+        Args:
+            modulus: Positive integer to divide by.
+            domains: Dictionary mapping Variable objects to their possible values.
+
+        Returns:
+            Set of possible remainders, or None if they are unknown.
+        """
+        return None
+
+    def narrow_residues(
+        self, modulus: int, allowed: set[int], domains: dict["Variable", Sequence[int]]
+    ) -> bool:
+        """
+        Remove values that cannot make this expression leave one of the
+        `allowed` remainders when divided by `modulus` from the domains of its
+        variables. Narrowed domains are replaced in the dictionary; the
+        original sequences are never modified.
+
+        Args:
+            modulus: Positive integer to divide by.
+            allowed: Remainders the expression may leave.
+            domains: Dictionary mapping Variable objects to their possible values.
+
+        Returns:
+            False if the expression can no longer leave an allowed remainder,
+            True otherwise.
+        """
+        return True
+
 
 class Variable(Value):
     """
@@ -54,6 +159,66 @@ class Variable(Value):
     def variables(self) -> list["Variable"]:
         return [self]
 
+    def _source(self, slots: dict["Variable", int], namespace: dict) -> str:
+        return f"s[{slots[self]}]"
+
+    def bounds(
+        self, domains: dict["Variable", Sequence[int]]
+    ) -> tuple[int, int] | None:
+        domain = domains[self]
+        if not domain:
+            return None
+        values = _range_of(domain)
+        if values is not None:
+            return min(values[0], values[-1]), max(values[0], values[-1])
+        return min(domain), max(domain)
+
+    def narrow(
+        self, lo: float, hi: float, domains: dict["Variable", Sequence[int]]
+    ) -> bool:
+        bounds = self.bounds(domains)
+        if bounds is None:
+            return False
+        if lo <= bounds[0] and bounds[1] <= hi:
+            return True
+        domain = domains[self]
+        values = _range_of(domain)
+        if values is not None:
+            # Cut ranges by bisection instead of listing their values.
+            ascending = values if values.step > 0 else values[::-1]
+            cut = ascending[
+                bisect.bisect_left(ascending, lo) : bisect.bisect_right(ascending, hi)
+            ]
+            narrowed = _like(domain, cut if values.step > 0 else cut[::-1])
+        else:
+            narrowed = [v for v in domain if lo <= v <= hi]
+        domains[self] = narrowed
+        return bool(narrowed)
+
+    def residues(
+        self, modulus: int, domains: dict["Variable", Sequence[int]]
+    ) -> set[int] | None:
+        values = _range_of(domains[self])
+        if values is not None:
+            # Remainders repeat after at most `modulus` steps.
+            return {values[k] % modulus for k in range(min(len(values), modulus))}
+        return {v % modulus for v in domains[self]}
+
+    def narrow_residues(
+        self, modulus: int, allowed: set[int], domains: dict["Variable", Sequence[int]]
+    ) -> bool:
+        domain = domains[self]
+        values = _range_of(domain)
+        if values is not None and values.step == 1 and len(allowed) == 1:
+            (residue,) = allowed
+            start = values.start + (residue - values.start) % modulus
+            narrowed = _like(domain, range(start, values.stop, modulus))
+        else:
+            narrowed = [v for v in domain if v % modulus in allowed]
+        if len(narrowed) != len(domain):
+            domains[self] = narrowed
+        return bool(narrowed)
+
 
 def variables(names: list[str]) -> list[Variable]:
     return [Variable(n) for n in names]
@@ -76,6 +241,36 @@ class Lit(Value):
     def variables(self) -> list[Variable]:
         return []
 
+    def _source(self, slots: dict["Variable", int], namespace: dict) -> str:
+        if type(self.val) is int:
+            return f"({self.val!r})"
+        namespace["_scalar_only"] = True
+        return _register(namespace, self.val)
+
+    def bounds(
+        self, domains: dict["Variable", Sequence[int]]
+    ) -> tuple[int, int] | None:
+        return self.val, self.val
+
+    def narrow(
+        self, lo: float, hi: float, domains: dict["Variable", Sequence[int]]
+    ) -> bool:
+        return lo <= self.val <= hi
+
+    def residues(
+        self, modulus: int, domains: dict["Variable", Sequence[int]]
+    ) -> set[int] | None:
+        if type(self.val) is not int:
+            return None
+        return {self.val % modulus}
+
+    def narrow_residues(
+        self, modulus: int, allowed: set[int], domains: dict["Variable", Sequence[int]]
+    ) -> bool:
+        if type(self.val) is not int:
+            return True
+        return self.val % modulus in allowed
+
 
 @dataclass
 class Add(Value):
@@ -88,6 +283,71 @@ class Add(Value):
     def variables(self) -> list[Variable]:
         return filter_variables(self.operand1.variables() + self.operand2.variables())
 
+    def _source(self, slots: dict["Variable", int], namespace: dict) -> str:
+        cached = _cached_source(self, namespace)
+        if cached is not None:
+            return cached
+        left = self.operand1._source(slots, namespace)
+        right = self.operand2._source(slots, namespace)
+        return f"({left} + {right})"
+
+    def bounds(
+        self, domains: dict["Variable", Sequence[int]]
+    ) -> tuple[int, int] | None:
+        bounds1 = self.operand1.bounds(domains)
+        bounds2 = self.operand2.bounds(domains)
+        if bounds1 is None or bounds2 is None:
+            return None
+        return bounds1[0] + bounds2[0], bounds1[1] + bounds2[1]
+
+    def narrow(
+        self, lo: float, hi: float, domains: dict["Variable", Sequence[int]]
+    ) -> bool:
+        bounds2 = self.operand2.bounds(domains)
+        if bounds2 is None:
+            return True
+        if not self.operand1.narrow(lo - bounds2[1], hi - bounds2[0], domains):
+            return False
+        bounds1 = self.operand1.bounds(domains)
+        if bounds1 is None:
+            return True
+        return self.operand2.narrow(lo - bounds1[1], hi - bounds1[0], domains)
+
+    def residues(
+        self, modulus: int, domains: dict["Variable", Sequence[int]]
+    ) -> set[int] | None:
+        return _combine_residues(
+            self.operand1.residues(modulus, domains),
+            self.operand2.residues(modulus, domains),
+            modulus,
+            lambda x, y: x + y,
+        )
+
+    def narrow_residues(
+        self, modulus: int, allowed: set[int], domains: dict["Variable", Sequence[int]]
+    ) -> bool:
+        allowed1 = _combine_residues(
+            allowed,
+            self.operand2.residues(modulus, domains),
+            modulus,
+            lambda total, y: total - y,
+        )
+        if allowed1 is not None and not self.operand1.narrow_residues(
+            modulus, allowed1, domains
+        ):
+            return False
+        allowed2 = _combine_residues(
+            allowed,
+            self.operand1.residues(modulus, domains),
+            modulus,
+            lambda total, x: total - x,
+        )
+        if allowed2 is not None and not self.operand2.narrow_residues(
+            modulus, allowed2, domains
+        ):
+            return False
+        return True
+
 
 @dataclass
 class Subtract(Value):
@@ -100,6 +360,71 @@ class Subtract(Value):
     def variables(self) -> list[Variable]:
         return filter_variables(self.operand1.variables() + self.operand2.variables())
 
+    def _source(self, slots: dict["Variable", int], namespace: dict) -> str:
+        cached = _cached_source(self, namespace)
+        if cached is not None:
+            return cached
+        left = self.operand1._source(slots, namespace)
+        right = self.operand2._source(slots, namespace)
+        return f"({left} - {right})"
+
+    def bounds(
+        self, domains: dict["Variable", Sequence[int]]
+    ) -> tuple[int, int] | None:
+        bounds1 = self.operand1.bounds(domains)
+        bounds2 = self.operand2.bounds(domains)
+        if bounds1 is None or bounds2 is None:
+            return None
+        return bounds1[0] - bounds2[1], bounds1[1] - bounds2[0]
+
+    def narrow(
+        self, lo: float, hi: float, domains: dict["Variable", Sequence[int]]
+    ) -> bool:
+        bounds2 = self.operand2.bounds(domains)
+        if bounds2 is None:
+            return True
+        if not self.operand1.narrow(lo + bounds2[0], hi + bounds2[1], domains):
+            return False
+        bounds1 = self.operand1.bounds(domains)
+        if bounds1 is None:
+            return True
+        return self.operand2.narrow(bounds1[0] - hi, bounds1[1] - lo, domains)
+
+    def residues(
+        self, modulus: int, domains: dict["Variable", Sequence[int]]
+    ) -> set[int] | None:
+        return _combine_residues(
+            self.operand1.residues(modulus, domains),
+            self.operand2.residues(modulus, domains),
+            modulus,
+            lambda x, y: x - y,
+        )
+
+    def narrow_residues(
+        self, modulus: int, allowed: set[int], domains: dict["Variable", Sequence[int]]
+    ) -> bool:
+        allowed1 = _combine_residues(
+            allowed,
+            self.operand2.residues(modulus, domains),
+            modulus,
+            lambda difference, y: difference + y,
+        )
+        if allowed1 is not None and not self.operand1.narrow_residues(
+            modulus, allowed1, domains
+        ):
+            return False
+        allowed2 = _combine_residues(
+            self.operand1.residues(modulus, domains),
+            allowed,
+            modulus,
+            lambda x, difference: x - difference,
+        )
+        if allowed2 is not None and not self.operand2.narrow_residues(
+            modulus, allowed2, domains
+        ):
+            return False
+        return True
+
 
 @dataclass
 class Multiply(Value):
@@ -112,6 +437,73 @@ class Multiply(Value):
     def variables(self) -> list[Variable]:
         return filter_variables(self.operand1.variables() + self.operand2.variables())
 
+    def _source(self, slots: dict["Variable", int], namespace: dict) -> str:
+        cached = _cached_source(self, namespace)
+        if cached is not None:
+            return cached
+        left = self.operand1._source(slots, namespace)
+        right = self.operand2._source(slots, namespace)
+        return f"({left} * {right})"
+
+    def bounds(
+        self, domains: dict["Variable", Sequence[int]]
+    ) -> tuple[int, int] | None:
+        bounds1 = self.operand1.bounds(domains)
+        bounds2 = self.operand2.bounds(domains)
+        if bounds1 is None or bounds2 is None:
+            return None
+        products = [x * y for x in bounds1 for y in bounds2]
+        return min(products), max(products)
+
+    def narrow(
+        self, lo: float, hi: float, domains: dict["Variable", Sequence[int]]
+    ) -> bool:
+        for operand, other in (
+            (self.operand1, self.operand2),
+            (self.operand2, self.operand1),
+        ):
+            other_bounds = other.bounds(domains)
+            if other_bounds is None:
+                continue
+            if other_bounds == (0, 0):
+                # The product is 0 whatever this operand is.
+                if not lo <= 0 <= hi:
+                    return False
+                continue
+            quotient = _divide_bounds(lo, hi, *other_bounds)
+            if quotient is not None and not operand.narrow(*quotient, domains):
+                return False
+        return True
+
+    def residues(
+        self, modulus: int, domains: dict["Variable", Sequence[int]]
+    ) -> set[int] | None:
+        return _combine_residues(
+            self.operand1.residues(modulus, domains),
+            self.operand2.residues(modulus, domains),
+            modulus,
+            lambda x, y: x * y,
+        )
+
+    def narrow_residues(
+        self, modulus: int, allowed: set[int], domains: dict["Variable", Sequence[int]]
+    ) -> bool:
+        for operand, other in (
+            (self.operand1, self.operand2),
+            (self.operand2, self.operand1),
+        ):
+            other_residues = other.residues(modulus, domains)
+            if other_residues is None:
+                continue
+            if modulus * len(other_residues) > _RESIDUE_LIMIT:
+                continue
+            operand_allowed = _factor_residues(
+                modulus, frozenset(allowed), frozenset(other_residues)
+            )
+            if not operand.narrow_residues(modulus, operand_allowed, domains):
+                return False
+        return True
+
 
 class Constraint(ABC):
     """
@@ -142,6 +534,49 @@ class Constraint(ABC):
         """
         pass
 
+    def compile(self, slots: dict["Variable", int]) -> Callable[[list[int]], bool]:
+        """
+        Compile this constraint into a plain function of a slot array.
+
+        Args:
+            slots: Dictionary mapping each Variable to its index in the slot array.
+
+        Returns:
+            Function taking a list of variable values, indexed by slot, and
+            returning True if the constraint is satisfied.
+        """
+        namespace: dict = {}
+        return _compile_source(self._source(slots, namespace), namespace)
+
+    def _source(self, slots: dict["Variable", int], namespace: dict) -> str:
+        """
+        Return a Python expression over the slot array `s` that checks this
+        constraint. Subclasses without a specialised expression fall back to
+        calling is_satisfied() with a bindings dict built from the slot array.
+        """
+        variables = self.variables()
+
+        def is_satisfied(s: list[int]) -> bool:
+            return self.is_satisfied({v: s[slots[v]] for v in variables})
+
+        namespace["_scalar_only"] = True
+        return f"bool({_register(namespace, is_satisfied)}(s))"
+
+    def propagate(self, domains: dict["Variable", Sequence[int]]) -> bool:
+        """
+        Remove values that cannot be part of any solution of this constraint
+        from the domains of its variables. Narrowed domains are replaced in
+        the dictionary; the original sequences are never modified. The
+        default implementation removes nothing.
+
+        Args:
+            domains: Dictionary mapping Variable objects to their possible values.
+
+        Returns:
+            False if the constraint can no longer be satisfied, True otherwise.
+        """
+        return True
+
 
 class Equal(Constraint):
     """
@@ -162,6 +597,20 @@ class Equal(Constraint):
     def variables(self) -> list[Variable]:
         return filter_variables(self.operand1.variables() + self.operand2.variables())
 
+    def _source(self, slots: dict["Variable", int], namespace: dict) -> str:
+        left = self.operand1._source(slots, namespace)
+        right = self.operand2._source(slots, namespace)
+        return f"({left} == {right})"
+
+    def propagate(self, domains: dict["Variable", Sequence[int]]) -> bool:
+        bounds2 = self.operand2.bounds(domains)
+        if bounds2 is not None and not self.operand1.narrow(*bounds2, domains):
+            return False
+        bounds1 = self.operand1.bounds(domains)
+        if bounds1 is not None and not self.operand2.narrow(*bounds1, domains):
+            return False
+        return True
+
 
 @dataclass
 class IsLessThan(Constraint):
@@ -182,6 +631,24 @@ class IsLessThan(Constraint):
     def variables(self) -> list[Variable]:
         return filter_variables(self.value.variables() + self.threshold.variables())
 
+    def _source(self, slots: dict["Variable", int], namespace: dict) -> str:
+        value = self.value._source(slots, namespace)
+        threshold = self.threshold._source(slots, namespace)
+        return f"({value} < {threshold})"
+
+    def propagate(self, domains: dict["Variable", Sequence[int]]) -> bool:
+        threshold = self.threshold.bounds(domains)
+        if threshold is not None and not self.value.narrow(
+            -math.inf, threshold[1] - 1, domains
+        ):
+            return False
+        value = self.value.bounds(domains)
+        if value is not None and not self.threshold.narrow(
+            value[0] + 1, math.inf, domains
+        ):
+            return False
+        return True
+
 
 @dataclass
 class IsGreaterThan(Constraint):
@@ -202,6 +669,24 @@ class IsGreaterThan(Constraint):
     def variables(self) -> list[Variable]:
         return filter_variables(self.value.variables() + self.threshold.variables())
 
+    def _source(self, slots: dict["Variable", int], namespace: dict) -> str:
+        value = self.value._source(slots, namespace)
+        threshold = self.threshold._source(slots, namespace)
+        return f"({value} > {threshold})"
+
+    def propagate(self, domains: dict["Variable", Sequence[int]]) -> bool:
+        threshold = self.threshold.bounds(domains)
+        if threshold is not None and not self.value.narrow(
+            threshold[0] + 1, math.inf, domains
+        ):
+            return False
+        value = self.value.bounds(domains)
+        if value is not None and not self.threshold.narrow(
+            -math.inf, value[1] - 1, domains
+        ):
+            return False
+        return True
+
 
 class IsDivisibleBy(Constraint):
     """
@@ -224,6 +709,27 @@ class IsDivisibleBy(Constraint):
     def variables(self) -> list[Variable]:
         return filter_variables(self.value.variables() + self.divisible_by.variables())
 
+    def _source(self, slots: dict["Variable", int], namespace: dict) -> str:
+        value = self.value._source(slots, namespace)
+        divisible_by = self.divisible_by._source(slots, namespace)
+        return f"({value} % {divisible_by} == 0)"
+
+    def propagate(self, domains: dict["Variable", Sequence[int]]) -> bool:
+        divisor = self.divisible_by.bounds(domains)
+        if divisor is not None and divisor[0] == divisor[1] != 0:
+            if not self.value.narrow_residues(abs(divisor[0]), {0}, domains):
+                return False
+        value = self.value.bounds(domains)
+        if value is not None and value[0] == value[1]:
+            if isinstance(self.divisible_by, Variable):
+                domain = domains[self.divisible_by]
+                narrowed = [d for d in domain if d != 0 and value[0] % d == 0]
+                if len(narrowed) != len(domain):
+                    domains[self.divisible_by] = narrowed
+                if not narrowed:
+                    return False
+        return True
+
 
 class NOf(Constraint):
     """
@@ -246,6 +752,14 @@ class NOf(Constraint):
     def variables(self) -> list[Variable]:
         return _flatten([c.variables() for c in self.sub_constraints])
 
+    def _source(self, slots: dict["Variable", int], namespace: dict) -> str:
+        # Start the sum from 0 so that it counts satisfied sub-constraints
+        # rather than combining them with boolean operators.
+        subs = "".join(
+            f" + {c._source(slots, namespace)}" for c in self.sub_constraints
+        )
+        return f"(0{subs} == {self.n!r})"
+
 
 class AdditionCrosses10Boundary(Constraint):
     """
@@ -268,6 +782,14 @@ class AdditionCrosses10Boundary(Constraint):
     def variables(self) -> list[Variable]:
         return filter_variables(self.operand1.variables() + self.operand2.variables())
 
+    def _source(self, slots: dict["Variable", int], namespace: dict) -> str:
+        value1 = self.operand1._source(slots, namespace)
+        value2 = self.operand2._source(slots, namespace)
+        return f"({value1} % 10 + {value2} % 10 >= 10)"
+
+    def propagate(self, domains: dict["Variable", Sequence[int]]) -> bool:
+        return _propagate_carry(self.operand1, self.operand2, 10, domains)
+
 
 class AdditionCrosses100Boundary(Constraint):
     """
@@ -290,6 +812,53 @@ class AdditionCrosses100Boundary(Constraint):
     def variables(self) -> list[Variable]:
         return filter_variables(self.operand1.variables() + self.operand2.variables())
 
+    def _source(self, slots: dict["Variable", int], namespace: dict) -> str:
+        value1 = self.operand1._source(slots, namespace)
+        value2 = self.operand2._source(slots, namespace)
+        return f"({value1} % 100 + {value2} % 100 >= 100)"
+
+    def propagate(self, domains: dict["Variable", Sequence[int]]) -> bool:
+        return _propagate_carry(self.operand1, self.operand2, 100, domains)
+
+
+class _LexLessOrEqual(Constraint):
+    """
+    Symmetry-breaking constraint that the values of one list of variables
+    come no later than those of another in lexicographic order.
+
+    Args:
+        first: Variables whose values must come first.
+        second: Variables to compare them with, pairwise.
+    """
+
+    def __init__(self, first: list[Variable], second: list[Variable]):
+        self.first = first
+        self.second = second
+
+    def is_satisfied(self, bindings: dict["Variable", int]) -> bool:
+        first = tuple(bindings[v] for v in self.first)
+        return first <= tuple(bindings[v] for v in self.second)
+
+    def variables(self) -> list[Variable]:
+        return filter_variables(self.first + self.second)
+
+    def _source(self, slots: dict["Variable", int], namespace: dict) -> str:
+        if len(self.first) == 1:
+            return f"(s[{slots[self.first[0]]}] <= s[{slots[self.second[0]]}])"
+        # Tuples compare lexicographically, but not elementwise on arrays.
+        namespace["_scalar_only"] = True
+        first = "".join(f"s[{slots[v]}], " for v in self.first)
+        second = "".join(f"s[{slots[v]}], " for v in self.second)
+        return f"(({first}) <= ({second}))"
+
+    def propagate(self, domains: dict["Variable", Sequence[int]]) -> bool:
+        # Only the first pair is narrowed: once it is equal, the rest are free.
+        first, second = self.first[0], self.second[0]
+        bounds = second.bounds(domains)
+        if bounds is None or not first.narrow(-math.inf, bounds[1], domains):
+            return False
+        return second.narrow(first.bounds(domains)[0], math.inf, domains)
+
 
 def _flatten(lst: list) -> list:
     """
@@ -323,183 +892,3558 @@ def filter_variables(values: list[Value]) -> list[Variable]:
     return list(set([v for v in values if isinstance(v, Variable)]))
 
 
-def _backtrack(
-    variables: list[Variable],
-    domains: dict[Variable, list[int]],
-    constraints: list[Constraint],
-) -> dict[Variable, int] | None:
+# Ranges with more values than this are shuffled lazily, rather than listed
+# and shuffled.
+_LAZY_SHUFFLE_SIZE = 1000
+
+# Odd 64-bit constant that mixes the bits of _Permutation's round inputs.
+_PERMUTATION_MIX = 0x9E3779B97F4A7C15
+
+
+class _Permutation:
     """
-    Internal backtracking solver for constraint satisfaction problems.
+    Pseudo-random permutation of range(size) that maps one index at a time,
+    so creating it costs the same however large `size` is.
+
+    A four-round Feistel network permutes the integers below the smallest
+    power of 4 that is at least `size`. Indices it maps outside range(size)
+    are mapped again until they land inside, which takes fewer than four
+    rounds on average.
 
     Args:
-        variables: List of Variable objects to assign.
-        domains: Dictionary mapping Variable objects to their possible values.
-        constraints: List of constraints that must be satisfied.
+        size: Number of indices to permute.
+    """
 
-    Returns:
-        Dictionary mapping variables to values that satisfies all constraints,
-        or None if no solution exists.
+    def __init__(self, size: int):
+        self.size = size
+        self.half = max(1, ((size - 1).bit_length() + 1) // 2)
+        self.mask = (1 << self.half) - 1
+        self.keys = [random.getrandbits(64) for _ in range(4)]
+
+    def __call__(self, index: int) -> int:
+        half, mask = self.half, self.mask
+        while True:
+            left, right = index >> half, index & mask
+            for key in self.keys:
+                mixed = ((right ^ key) * _PERMUTATION_MIX) >> 32
+                left, right = right, left ^ (mixed & mask)
+            index = (left << half) | right
+            if index < self.size:
+                return index
+
+
+class _PermutedRange(Sequence[int]):
     """
+    The values of a range in a pseudo-random order, computed as they are
+    read, so large domains can be shuffled without listing their values.
+    Size and membership take constant time, as they do for the range.
 
-    def is_consistent(assignment: dict[Variable, int]) -> bool:
-        return all(
-            constraint.is_satisfied(assignment)
-            for constraint in constraints
-            if set(constraint.variables()).issubset(set(assignment.keys()))
-        )
+    Args:
+        values: Range to permute.
+    """
 
-    def backtrack_helper(
-        assignment: dict[Variable, int],
-    ) -> dict[Variable, int] | None:
-        if len(assignment) == len(variables):
-            if is_consistent(assignment) and not all(
-                v == 0 for v in assignment.values()
-            ):
-                return assignment.copy()
-            return None
+    def __init__(self, values: range):
+        self.values = values
+        self.permutation = _Permutation(len(values))
 
-        var = next(v for v in variables if v not in assignment)
-        for value in domains[var]:
-            assignment[var] = value
-            if is_consistent(assignment):
-                result = backtrack_helper(assignment)
-                if result is not None:
-                    return result
-            del assignment[var]
-        return None
+    def __len__(self) -> int:
+        return len(self.values)
 
-    return backtrack_helper({})
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self.values)
+        if not 0 <= index < len(self.values):
+            raise IndexError("domain index out of range")
+        return self.values[self.permutation(index)]
 
+    def __iter__(self) -> Iterable[int]:
+        values, permutation = self.values, self.permutation
+        for index in range(len(values)):
+            yield values[permutation(index)]
 
-def gen_bindings(
-    variables: list[Variable],
-    domains: dict[Variable, list[int]],
-    constraints: list[Constraint],
-) -> Generator[dict[Variable, int], None, None]:
+    def __contains__(self, value: object) -> bool:
+        return value in self.values
+
+
+def _range_of(domain: Sequence[int]) -> range | None:
     """
-    Generate solutions to a constraint satisfaction problem.
+    Return the range that holds a domain's values, or None if the domain
+    isn't backed by a range.
+    """
+    if isinstance(domain, _PermutedRange):
+        return domain.values
+    if isinstance(domain, range):
+        return domain
+    return None
 
-    Args:
-        variables: List of Variable objects to assign.
-        domains: Dictionary mapping Variable objects to their possible values.
-        constraints: List of constraints that must be satisfied.
 
-    Yields:
-        Dictionary mapping variables to values that satisfies all constraints.
+def _shuffle(domain: Sequence[int]) -> Sequence[int]:
     """
-    domains_copy = {var: list(domain) for var, domain in domains.items()}
+    Return a domain's values in a random order. Ranges of more than
+    _LAZY_SHUFFLE_SIZE values are permuted lazily; other domains are copied
+    into a list and shuffled.
+    """
+    values = _range_of(domain)
+    if values is not None and len(values) > _LAZY_SHUFFLE_SIZE:
+        return _PermutedRange(values)
+    shuffled = list(domain)
+    random.shuffle(shuffled)
+    return shuffled
 
-    while True:
-        for domain in domains_copy.values():
-            random.shuffle(domain)
 
-        solution = _backtrack(variables, domains_copy, constraints)
-        if solution is None:
-            break
-        yield solution
+def _like(domain: Sequence[int], values: range) -> Sequence[int]:
+    """
+    Return a range cut from a range-backed domain, shuffled again if the
+    domain was shuffled.
+    """
+    if isinstance(domain, _PermutedRange):
+        return _shuffle(values)
+    return values
 
 
-def find_bindings(
-    variables: list[Variable],
-    domains: dict[Variable, list[int]],
-    constraints: list[Constraint],
-    n_bindings: int = 1,
-) -> list[dict[Variable, int]]:
+def _divide_bounds(
+    lo: float, hi: float, divisor_lo: int, divisor_hi: int
+) -> tuple[float, float] | None:
     """
-    Find multiple solutions to a constraint satisfaction problem.
+    Compute the integers q for which q * d can lie in [lo, hi] for some
+    divisor d in [divisor_lo, divisor_hi].
 
     Args:
-        variables: List of Variable objects to assign.
-        domains: Dictionary mapping Variable objects to their possible values.
-        constraints: List of constraints that must be satisfied.
-        n_bindings: Number of solutions to find (default=1).
+        lo: Lowest allowed product (may be -inf).
+        hi: Highest allowed product (may be inf).
+        divisor_lo: Lowest possible divisor.
+        divisor_hi: Highest possible divisor.
 
     Returns:
-        List of dictionaries mapping variables to values that satisfy all constraints.
+        (lowest, highest) pair of possible quotients, or None if the divisor
+        range contains 0, in which case any quotient is possible.
     """
-    gen = gen_bindings(variables, domains, constraints)
-    all_bindings = []
-    for _ in range(n_bindings):
-        try:
-            all_bindings.append(next(gen))
-        except StopIteration:
-            break
-    return all_bindings
+    if divisor_lo <= 0 <= divisor_hi:
+        return None
 
+    # The real quotients are extreme at the corners, and rounding is
+    # monotonic, so the integer range runs from the smallest rounded-up
+    # corner quotient to the largest rounded-down one.
+    ceilings = []
+    floors = []
+    for product in (lo, hi):
+        for divisor in (divisor_lo, divisor_hi):
+            if math.isinf(product):
+                quotient = product if divisor > 0 else -product
+                ceilings.append(quotient)
+                floors.append(quotient)
+            else:
+                ceilings.append(-(-product // divisor))
+                floors.append(product // divisor)
+    return min(ceilings), max(floors)
 
-def n_solutions(
-    variables: list[Variable],
-    domains: dict[Variable, list[int]],
-    constraints: list[Constraint],
-) -> int:
+
+# Largest number of remainder combinations worked through when computing or
+# narrowing the remainders of an operator's result.
+_RESIDUE_LIMIT = 1000
+
+
+def _combine_residues(
+    residues1: set[int] | None,
+    residues2: set[int] | None,
+    modulus: int,
+    combine: Callable[[int, int], int],
+) -> set[int] | None:
     """
-    Count the number of solutions to a constraint satisfaction problem.
+    Combine every pair of remainders with an operator.
 
     Args:
-        variables: List of Variable objects to assign.
-        domains: Dictionary mapping Variable objects to their possible values.
-        constraints: List of constraints that must be satisfied.
+        residues1: Remainders of the first operand, or None if unknown.
+        residues2: Remainders of the second operand, or None if unknown.
+        modulus: Positive integer the remainders are taken by.
+        combine: Operator to apply to each pair.
 
     Returns:
-        Number of unique solutions found.
+        Set of remainders of the results, or None if either operand's
+        remainders are unknown or there are too many pairs to combine.
     """
-    return sum(1 for _ in find_bindings(variables, domains, constraints))
+    if residues1 is None or residues2 is None:
+        return None
+    if len(residues1) * len(residues2) > _RESIDUE_LIMIT:
+        return None
+    return {combine(x, y) % modulus for x in residues1 for y in residues2}
 
 
-def expression_string(
-    expression: Value,
-    values: dict[Variable, int],
-    hold_out: Variable | None = None,
-    underline: Variable | None = None,
-) -> str:
+@functools.lru_cache(maxsize=4096)
+def _factor_residues(
+    modulus: int, allowed: frozenset[int], factors: frozenset[int]
+) -> frozenset[int]:
     """
-    Convert a value expression to a string representation with variable values.
+    Find the remainders that give an allowed remainder when multiplied by
+    one of `factors`. Propagation asks the same question at many nodes, so
+    the answers are cached.
 
     Args:
-        expression: Value expression to convert to string.
-        values: Dictionary mapping Variable objects to their values.
-        hold_out: Optional variable to replace with underscores.
-        underline: Optional variable to underline in output.
+        modulus: Positive integer the remainders are taken by.
+        allowed: Remainders the product may leave.
+        factors: Remainders the other factor may leave.
 
     Returns:
-        String representation of the expression with variables replaced by their values.
+        Set of remainders of the factor being narrowed.
     """
+    return frozenset(
+        x for x in range(modulus) for y in factors if x * y % modulus in allowed
+    )
 
-    def _generate(expr: Value, parent_op: str = None) -> str:
-        if isinstance(expr, Variable):
-            if expr == hold_out:
-                return "_" * len(str(values[expr]))
-            elif expr == underline:
-                return f"<u>{str(values[expr])}</u>"
-            else:
-                return str(values[expr])
-        elif isinstance(expr, Lit):
-            return str(expr.val)
-        elif isinstance(expr, Add):
-            left = _generate(expr.operand1, "+")
-            right = _generate(expr.operand2, "+")
-            result = f"{left} + {right}"
-            if parent_op in ("*", "-"):
-                return f"({result})"
-            return result
-        elif isinstance(expr, Subtract):
-            left = _generate(expr.operand1, "-")
-            right = _generate(expr.operand2, "-")
-            result = f"{left} - {right}"
-            if parent_op in ("*", "-"):
-                return f"({result})"
-            return result
-        elif isinstance(expr, Multiply):
-            left = _generate(expr.operand1, "*")
-            right = _generate(expr.operand2, "*")
-            return f"{left} x {right}"
-        else:
-            raise ValueError(f"Unsupported expression type: {type(expr)}")
 
-    return _generate(expression)
+def _propagate_carry(
+    operand1: Value,
+    operand2: Value,
+    modulus: int,
+    domains: dict[Variable, Sequence[int]],
+) -> bool:
+    """
+    Narrow the operands of a constraint that adding them carries past
+    `modulus`: each operand's remainder must be at least `modulus` minus the
+    other operand's largest remainder.
 
+    Args:
+        operand1: First value to add.
+        operand2: Second value to add.
+        modulus: 10 to carry past the ones digit, 100 for the tens digit.
+        domains: Dictionary mapping Variable objects to their possible values.
 
-def uniform_domains(
-    variables: list[Variable], domain: Sequence[int]
-) -> dict[Variable, list[int]]:
+    Returns:
+        False if the addition can no longer carry, True otherwise.
+    """
+    for value, other in ((operand1, operand2), (operand2, operand1)):
+        residues = other.residues(modulus, domains)
+        if residues is None:
+            continue
+        if not residues:
+            return False
+        allowed = set(range(modulus - max(residues), modulus))
+        if not value.narrow_residues(modulus, allowed, domains):
+            return False
+    return True
+
+
+def _cached_source(value: Value, namespace: dict) -> str | None:
+    """
+    Return the expression that reads a shared subexpression's value from the
+    template's cache, or None if the subexpression isn't cached.
+    """
+    index = namespace.get("_shared", {}).get(id(value))
+    if index is None:
+        return None
+    return f"{namespace['_cache']}[{index}]"
+
+
+def _structure(value: Value) -> tuple | None:
+    """
+    Structural key of a built-in expression: equal expressions get equal
+    keys even when they are different objects.
+
+    Returns:
+        Hashable key, or None if the expression contains a custom Value.
+    """
+    if isinstance(value, Variable):
+        return ("var", id(value))
+    if type(value) is Lit and type(value.val) is int:
+        return ("lit", value.val)
+    if type(value) in (Add, Subtract, Multiply):
+        left = _structure(value.operand1)
+        right = _structure(value.operand2)
+        if left is None or right is None:
+            return None
+        return (type(value).__name__, left, right)
+    return None
+
+
+def _canonical(
+    node: Value | Constraint, rename: dict[Variable, Variable]
+) -> tuple | None:
+    """
+    Structural key of a value or constraint with its variables renamed,
+    equal for nodes that differ only in the order of the operands of
+    commutative operations and symmetric constraints.
+
+    Args:
+        node: Value expression or constraint to describe.
+        rename: Dictionary mapping variables to the variables that replace them.
+
+    Returns:
+        Hashable key, or None if the node contains a custom value or
+        constraint that uses a renamed variable.
+    """
+    if isinstance(node, Variable):
+        return ("var", id(rename.get(node, node)))
+    if type(node) is Lit:
+        return ("lit", node.val)
+    if type(node) is NOf:
+        keys = [_canonical(c, rename) for c in node.sub_constraints]
+        if None in keys:
+            return None
+        return ("NOf", node.n, tuple(sorted(keys)))
+    if type(node) is IsGreaterThan:
+        # value > threshold is the same constraint as threshold < value.
+        keys = [_canonical(node.threshold, rename), _canonical(node.value, rename)]
+        name = "IsLessThan"
+    elif type(node) in (Subtract, IsLessThan, IsDivisibleBy):
+        keys = [_canonical(operand, rename) for operand in _operands(node)]
+        name = type(node).__name__
+    elif type(node) in (Add, Multiply):
+        # Sums and products are keyed by their terms, so that x + y + z
+        # matches z + (y + x) however the terms are grouped.
+        keys = [_canonical(term, rename) for term in _terms(node, type(node))]
+        if None not in keys:
+            keys.sort()
+        name = type(node).__name__
+    elif type(node) in (
+        Equal,
+        AdditionCrosses10Boundary,
+        AdditionCrosses100Boundary,
+    ):
+        keys = [_canonical(operand, rename) for operand in _operands(node)]
+        if None not in keys:
+            keys.sort()
+        name = type(node).__name__
+    elif any(v in rename for v in node.variables()):
+        return None
+    else:
+        return ("custom", id(node))
+    if None in keys:
+        return None
+    return (name, *keys)
+
+
+def _terms(value: Value, kind: type) -> list[Value]:
+    """
+    Flatten nested operations of one kind, such as (a + b) + c, into the
+    list of their operands.
+    """
+    if type(value) is not kind:
+        return [value]
+    return _terms(value.operand1, kind) + _terms(value.operand2, kind)
+
+
+def _appearances(node: Value | Constraint) -> list[Variable]:
+    """
+    List the variables of a built-in value or constraint in the order they
+    first appear, left to right.
+    """
+    found = [n for n in _walk(node) if isinstance(n, Variable)]
+    return list(dict.fromkeys(found))
+
+
+def _operands(node: Value | Constraint) -> list:
+    """
+    List the values and sub-constraints of a built-in value or constraint.
+    """
+    if isinstance(node, (Add, Subtract, Multiply, Equal)):
+        return [node.operand1, node.operand2]
+    if isinstance(node, (AdditionCrosses10Boundary, AdditionCrosses100Boundary)):
+        return [node.operand1, node.operand2]
+    if isinstance(node, (IsLessThan, IsGreaterThan)):
+        return [node.value, node.threshold]
+    if isinstance(node, IsDivisibleBy):
+        return [node.value, node.divisible_by]
+    if isinstance(node, NOf):
+        return node.sub_constraints
+    return []
+
+
+def _walk(node: Value | Constraint) -> Generator[Value | Constraint, None, None]:
+    """
+    Yield a built-in value or constraint and everything inside it.
+    """
+    yield node
+    for operand in _operands(node):
+        yield from _walk(operand)
+
+
+def _register(namespace: dict, obj: object) -> str:
+    """
+    Store an object in a code-generation namespace and return the name that
+    generated code can use to refer to it.
+    """
+    name = f"_f{len(namespace)}"
+    namespace[name] = obj
+    return name
+
+
+def _compile_source(source: str, namespace: dict) -> Callable:
+    """
+    Turn a generated expression over the slot array `s` into a function.
+
+    Args:
+        source: Python expression that reads variable values from `s`.
+        namespace: Objects referred to by name from the expression.
+
+    Returns:
+        Function taking the slot array and returning the expression's value.
+        Its `vectorizable` attribute is True if the expression also works
+        when slots hold NumPy arrays.
+    """
+    code = compile(f"lambda s: {source}", "<sumchef>", "eval")
+    function = eval(code, namespace)
+    function.vectorizable = not namespace.get("_scalar_only", False)
+    return function
+
+
+def _magnitude(node: Value | Constraint) -> tuple[int, int, int] | None:
+    """
+    Bound the size of the integers a built-in value or constraint computes.
+
+    Args:
+        node: Value expression or constraint to bound.
+
+    Returns:
+        (count, degree, largest literal) such that every intermediate result
+        is at most count * k ** degree in absolute value, where k is at least
+        1, the largest literal, and the largest variable value, or None if
+        the node isn't built from the built-in classes.
+    """
+    if isinstance(node, Variable):
+        return 1, 1, 0
+    elif isinstance(node, Lit):
+        return (1, 1, abs(node.val)) if type(node.val) is int else None
+    elif isinstance(node, NOf):
+        operands = node.sub_constraints
+    elif isinstance(node, (IsLessThan, IsGreaterThan)):
+        operands = [node.value, node.threshold]
+    elif isinstance(node, IsDivisibleBy):
+        operands = [node.value, node.divisible_by]
+    elif isinstance(
+        node,
+        (
+            Add,
+            Subtract,
+            Multiply,
+            Equal,
+            AdditionCrosses10Boundary,
+            AdditionCrosses100Boundary,
+        ),
+    ):
+        operands = [node.operand1, node.operand2]
+    else:
+        return None
+
+    bounds = [_magnitude(operand) for operand in operands]
+    if any(b is None for b in bounds):
+        return None
+    if not bounds:
+        return 1, 1, 0
+    largest_literal = max(b[2] for b in bounds)
+    if isinstance(node, Multiply):
+        (count1, degree1, _), (count2, degree2, _) = bounds
+        return count1 * count2, degree1 + degree2, largest_literal
+    return sum(b[0] for b in bounds), max(b[1] for b in bounds), largest_literal
+
+
+# Largest intermediate result allowed when checking with 64-bit NumPy arrays.
+_VECTORIZE_LIMIT = 2**62
+
+
+def _is_linear(value: Value, var: Variable) -> bool:
+    """
+    Check whether a value expression is linear in a variable, that is, whether
+    it can be written as a * var + b where a and b don't depend on var.
+
+    Args:
+        value: Value expression to check.
+        var: Variable to check linearity in.
+
+    Returns:
+        True if the expression is linear in the variable.
+    """
+    if var not in value.variables():
+        return True
+    elif isinstance(value, Variable):
+        return True
+    elif isinstance(value, (Add, Subtract)):
+        return _is_linear(value.operand1, var) and _is_linear(value.operand2, var)
+    elif isinstance(value, Multiply):
+        if var not in value.operand1.variables():
+            return _is_linear(value.operand2, var)
+        if var not in value.operand2.variables():
+            return _is_linear(value.operand1, var)
+    return False
+
+
+def _linear_solver(
+    difference: Callable[[list[int]], int], slot: int
+) -> Callable[[list[int]], list | None]:
+    """
+    Build a function that solves difference(s) == 0 for the variable in `slot`,
+    given that the difference is linear in that variable.
+
+    Args:
+        difference: Compiled expression that must equal 0.
+        slot: Slot of the variable to solve for.
+
+    Returns:
+        Function taking the slot array and returning a list holding the only
+        value that solves the equation, an empty list if no integer does,
+        or None if every value does.
+    """
+
+    def solve(s: list[int]) -> list | None:
+        s[slot] = 0
+        offset = difference(s)
+        s[slot] = 1
+        coefficient = difference(s) - offset
+        if coefficient == 0:
+            return None if offset == 0 else []
+        value, remainder = divmod(-offset, coefficient)
+        return [] if remainder else [value]
+
+    return solve
+
+
+# Number of constraint revisions allowed per constraint in one call to
+# CompiledTemplate.propagate.
+_PROPAGATION_BUDGET = 50
+
+# Most constraint revisions allowed when propagating to a fixpoint before
+# the search starts, where a dead end costs the most to find later. Two
+# constraints that feed each other can narrow bounds by one value per
+# revision, so a fixpoint can take as many revisions as the domains have
+# values; this only cuts short domains of about a million values or more.
+_FIXPOINT_BUDGET = 10**6
+
+
+class CompiledTemplate:
+    """
+    A set of constraints compiled into plain Python functions that read their
+    variables from a slot array, ready for the solver's hot path.
+
+    Each variable's slot is its position in `variables`. Constraints that use
+    a variable outside of `variables` can never be decided, so they are left
+    out, exactly as the solver has always ignored them.
+
+    Args:
+        variables: List of Variable objects to assign.
+        constraints: List of constraints that must be satisfied.
+    """
+
+    def __init__(self, variables: list[Variable], constraints: list[Constraint]):
+        self.variables = list(variables)
+        self.constraints = list(constraints)
+        self.slots = {v: i for i, v in enumerate(self.variables)}
+        self.checks: list[tuple[frozenset[int], Callable[[list[int]], bool]]] = []
+        # The constraint behind each check, in the same order as checks.
+        self.checked: list[Constraint] = []
+        # The position in constraints of the constraint behind each check.
+        self.positions: list[int] = []
+        # watchers[slot] lists the checks that use the variable in that slot,
+        # in the order they run once that variable is bound.
+        self.watchers: list[list[int]] = [[] for _ in self.variables]
+        for position, constraint in enumerate(self.constraints):
+            constraint_vars = constraint.variables()
+            if not all(v in self.slots for v in constraint_vars):
+                continue
+            needed = frozenset(self.slots[v] for v in constraint_vars)
+            for slot in needed:
+                self.watchers[slot].append(len(self.checks))
+            self.checks.append((needed, constraint.compile(self.slots)))
+            self.checked.append(constraint)
+            self.positions.append(position)
+        # Positions in constraints, in the order their checks run.
+        self.check_order = list(range(len(self.constraints)))
+        # Templates of the groups of variables that share no constraint,
+        # compiled on the first call to components().
+        self._components: list[CompiledTemplate] | None = None
+        self._share_subexpressions()
+        # Maps id(constraint) to the index of its check.
+        self.check_index = {id(c): i for i, c in enumerate(self.checked)}
+
+        # magnitudes[i] bounds the size of the integers check i works with,
+        # or is None if the check can't be run on NumPy arrays.
+        self.magnitudes = [
+            _magnitude(constraint) if getattr(check, "vectorizable", False) else None
+            for (_, check), constraint in zip(self.checks, self.checked)
+        ]
+
+        # solvers[(i, slot)] computes the value of the variable in `slot`
+        # directly from check i, when that check is an Equal in which the
+        # variable appears linearly.
+        self.solvers: dict[tuple[int, int], Callable[[list[int]], list | None]] = {}
+        for i, constraint in enumerate(self.checked):
+            if not isinstance(constraint, Equal):
+                continue
+            difference = Subtract(constraint.operand1, constraint.operand2)
+            for slot in self.checks[i][0]:
+                if _is_linear(difference, self.variables[slot]):
+                    self.solvers[(i, slot)] = _linear_solver(
+                        difference.compile(self.slots), slot
+                    )
+
+        # Only constraints that override propagate() can narrow domains.
+        self.propagators = [
+            i
+            for i, constraint in enumerate(self.checked)
+            if type(constraint).propagate is not Constraint.propagate
+        ]
+        propagating = set(self.propagators)
+        self.propagator_watchers = [
+            [i for i in watching if i in propagating] for watching in self.watchers
+        ]
+
+        # Checks of a single variable, and arcs (i, x, y) for both directions
+        # of every check i of two variables x and y. arc_watchers[slot] lists
+        # the arcs whose values need support from the variable in that slot.
+        self.unary = [
+            i for i, (needed, _) in enumerate(self.checks) if len(needed) == 1
+        ]
+        self.arcs: list[tuple[int, int, int]] = []
+        self.arc_watchers: list[list[int]] = [[] for _ in self.variables]
+        for i, (needed, _) in enumerate(self.checks):
+            if len(needed) != 2:
+                continue
+            x, y = sorted(needed)
+            for arc in ((i, x, y), (i, y, x)):
+                self.arc_watchers[arc[2]].append(len(self.arcs))
+                self.arcs.append(arc)
+
+    def _share_subexpressions(self) -> None:
+        """
+        Find the arithmetic subexpressions that appear more than once across
+        the checks, such as a product used by several constraints, and
+        compile the checks again to read them from a cache.
+
+        shared[k] is the (slots, function) pair that computes subexpression
+        k into cache[k], and shared_watchers[slot] lists the subexpressions
+        that use the variable in that slot. The search computes each one
+        once, when the last of its variables is bound, and runs fast_checks
+        instead of the checks. Inner subexpressions come before the ones
+        that contain them.
+        """
+        counts: dict[tuple, int] = {}
+        keys: dict[int, tuple] = {}
+        nodes: list[Value] = []
+
+        def visit(node: Value | Constraint) -> None:
+            for operand in _operands(node):
+                visit(operand)
+            if type(node) in (Add, Subtract, Multiply) and node.variables():
+                key = _structure(node)
+                if key is not None:
+                    counts[key] = counts.get(key, 0) + 1
+                    keys[id(node)] = key
+                    nodes.append(node)
+
+        for constraint in self.checked:
+            visit(constraint)
+
+        # Nodes were visited inner first, so this numbers inner
+        # subexpressions first.
+        indices: dict[tuple, int] = {}
+        representatives: list[Value] = []
+        for node in nodes:
+            key = keys[id(node)]
+            if counts[key] > 1 and key not in indices:
+                indices[key] = len(representatives)
+                representatives.append(node)
+        shared_ids = {
+            node_id: indices[key] for node_id, key in keys.items() if key in indices
+        }
+
+        self.cache: list = [0] * len(representatives)
+        self.shared: list[tuple[frozenset[int], Callable[[list[int]], bool]]] = []
+        self.shared_watchers: list[list[int]] = [[] for _ in self.variables]
+        self.plain_checks = [check for _, check in self.checks]
+        self.fast_checks = list(self.plain_checks)
+        if not representatives:
+            return
+
+        def namespace(exclude: int | None = None) -> dict:
+            result: dict = {
+                "_shared": {
+                    node_id: index
+                    for node_id, index in shared_ids.items()
+                    if index != exclude
+                },
+            }
+            result["_cache"] = _register(result, self.cache)
+            return result
+
+        for index, node in enumerate(representatives):
+            needed = frozenset(self.slots[v] for v in node.variables())
+            for slot in needed:
+                self.shared_watchers[slot].append(index)
+            # The expression stores the value and returns True, so it can
+            # run in the same list as the checks.
+            names = namespace(exclude=index)
+            source = node._source(self.slots, names)
+            compute = f"({names['_cache']}.__setitem__({index}, {source}) is None)"
+            self.shared.append((needed, _compile_source(compute, names)))
+        for i, constraint in enumerate(self.checked):
+            if any(id(node) in shared_ids for node in _walk(constraint)):
+                names = namespace()
+                self.fast_checks[i] = _compile_source(
+                    constraint._source(self.slots, names), names
+                )
+
+    def order_checks(self, order: Sequence[int]) -> None:
+        """
+        Change the order in which checks that become decidable together run.
+
+        The solver stops at the first check that fails, so running cheap,
+        selective checks first saves evaluating the others.
+
+        Args:
+            order: Positions in `constraints`, most promising first.
+                Constraints left out run last, in declaration order.
+        """
+        rank = {position: r for r, position in enumerate(order)}
+        # The groups list their constraints in the order their checks run.
+        self._components = None
+        self.check_order = sorted(
+            range(len(self.constraints)),
+            key=lambda position: rank.get(position, len(rank) + position),
+        )
+        rank = {position: r for r, position in enumerate(self.check_order)}
+        for watching in self.watchers:
+            watching.sort(key=lambda i: rank[self.positions[i]])
+
+    def learn_check_order(
+        self, domains: dict[Variable, Sequence[int]], samples: int = 1000
+    ) -> list[int]:
+        """
+        Measure the checks on random assignments and run the best ones first.
+
+        Each check is timed on the same random assignments, and the checks
+        are ordered by their cost per rejected assignment, so a check that
+        is cheap or fails often runs before one that is slow or rarely
+        fails. The order is applied to this template and returned, so it can
+        be saved and passed to find_bindings() or gen_bindings() later.
+
+        Args:
+            domains: Dictionary mapping Variable objects to their possible values.
+            samples: Number of random assignments to measure (default=1000).
+
+        Returns:
+            Positions in `constraints`, in the order their checks now run.
+        """
+        if not all(domains[var] for var in self.variables):
+            return list(self.check_order)
+
+        assignments = [
+            [random.choice(domains[var]) for var in self.variables]
+            for _ in range(samples)
+        ]
+        scores = {}
+        for (needed, check), position in zip(self.checks, self.positions):
+            if not needed:
+                continue
+            start = time.perf_counter()
+            failures = sum(1 for s in assignments if not check(s))
+            elapsed = time.perf_counter() - start
+            # Smooth the failure rate so checks that never fail in the sample
+            # still get a finite score.
+            scores[position] = elapsed * (samples + 2) / (failures + 1)
+        self.order_checks(sorted(scores, key=scores.__getitem__))
+        return list(self.check_order)
+
+    def arc_consistency(
+        self,
+        domains: dict[Variable, Sequence[int]],
+        changed: Sequence[int] | None = None,
+        supports: dict | None = None,
+        limits: "_Budget | None" = None,
+    ) -> Constraint | None:
+        """
+        Remove every value that no value of another variable supports in a
+        constraint of just those two variables, until every remaining value
+        is supported. Narrowed domains are replaced in the dictionary and
+        keep their order.
+
+        This is AC-3 with residual supports: the value that last supported
+        each value is remembered and tried first, so a revision usually
+        costs one set lookup per value.
+
+        Args:
+            domains: Dictionary mapping Variable objects to their possible values.
+            changed: Slots whose domains have changed since the domains were
+                last made consistent, or None to revise every arc and also
+                filter the domains by the checks of a single variable.
+            supports: Residual supports to reuse between calls, updated in
+                place (default=None, start afresh).
+            limits: Limits that stop the search with SearchTimeout, charged
+                for every pair of values tried.
+
+        Returns:
+            The constraint that can no longer be satisfied, or None if every
+            constraint may still be satisfied.
+        """
+        if supports is None:
+            supports = {}
+        variables = self.variables
+        s: list[int] = [0] * len(variables)
+
+        if changed is None:
+            for i in self.unary:
+                needed, check = self.checks[i]
+                (slot,) = needed
+                domain = domains[variables[slot]]
+                kept = []
+                for value in domain:
+                    if limits is not None:
+                        limits.step()
+                    s[slot] = value
+                    if check(s):
+                        kept.append(value)
+                if len(kept) != len(domain):
+                    domains[variables[slot]] = kept
+                if not kept:
+                    return self.checked[i]
+            pending = list(range(len(self.arcs)))
+        else:
+            pending = list(
+                dict.fromkeys(a for slot in changed for a in self.arc_watchers[slot])
+            )
+        queued = set(pending)
+        while pending:
+            a = pending.pop()
+            queued.discard(a)
+            i, x, y = self.arcs[a]
+            check = self.checks[i][1]
+            domain = domains[variables[x]]
+            others = domains[variables[y]]
+            other_set = _range_of(others) or set(others)
+            kept = []
+            for value in domain:
+                support = supports.get((a, value))
+                if support is not None and support in other_set:
+                    kept.append(value)
+                    continue
+                s[x] = value
+                for other in others:
+                    if limits is not None:
+                        limits.step()
+                    s[y] = other
+                    if check(s):
+                        supports[(a, value)] = other
+                        kept.append(value)
+                        break
+            if len(kept) == len(domain):
+                continue
+            domains[variables[x]] = kept
+            if not kept:
+                return self.checked[i]
+            # Values of x supported only by removed values may have lost
+            # their support in other constraints. The reverse arc of this
+            # constraint can't have: removed values supported nothing.
+            for b in self.arc_watchers[x]:
+                if self.arcs[b][0] != i and b not in queued:
+                    pending.append(b)
+                    queued.add(b)
+        return None
+
+    def find_conflict(
+        self, domains: dict[Variable, Sequence[int]]
+    ) -> Constraint | None:
+        """
+        Look for a constraint that no assignment can satisfy, without
+        searching: constraints without variables are checked, and the rest
+        narrow copies of the domains by bounds and remainders until nothing
+        changes.
+
+        Args:
+            domains: Dictionary mapping Variable objects to their possible values.
+
+        Returns:
+            A constraint that proves there is no solution, or None if there
+            may be one.
+        """
+        for (needed, check), constraint in zip(self.checks, self.checked):
+            if not needed and not check([]):
+                return constraint
+        root_domains = {v: domains[v] for v in self.variables}
+        return self.propagate(root_domains, budget=None)
+
+    def symmetries(
+        self, domains: dict[Variable, Sequence[int]]
+    ) -> list[dict[Variable, Variable]]:
+        """
+        Find swaps of variables that turn every solution into another
+        solution, such as the operands of A*B, or A*B and C*D in
+        A*B + C*D = E when no other constraint tells them apart.
+
+        Two variables, or the variables of the two operands of an addition,
+        multiplication or symmetric constraint, can be swapped when their
+        domains hold the same values and swapping them leaves the
+        constraints unchanged up to the order of commutative operands.
+
+        Args:
+            domains: Dictionary mapping Variable objects to their possible values.
+
+        Returns:
+            List of swaps, each a dictionary mapping every swapped variable to
+            the variable it is swapped with.
+        """
+        candidates: list[dict[Variable, Variable]] = [
+            {x: y, y: x}
+            for i, x in enumerate(self.variables)
+            for y in self.variables[i + 1 :]
+        ]
+        for constraint in self.checked:
+            for node in _walk(constraint):
+                if type(node) in (Add, Multiply):
+                    operands = _terms(node, type(node))
+                elif type(node) in (
+                    Equal,
+                    AdditionCrosses10Boundary,
+                    AdditionCrosses100Boundary,
+                ):
+                    operands = _operands(node)
+                else:
+                    continue
+                for i, operand1 in enumerate(operands):
+                    for operand2 in operands[i + 1 :]:
+                        # Pair the operands' variables in order of appearance.
+                        vars1 = _appearances(operand1)
+                        vars2 = _appearances(operand2)
+                        if len(vars1) < 2 or len(vars1) != len(vars2):
+                            continue
+                        if set(vars1) & set(vars2):
+                            continue
+                        swap = dict(zip(vars1, vars2))
+                        swap.update(zip(vars2, vars1))
+                        candidates.append(swap)
+
+        values: dict[Variable, Sequence[int]] = {}
+        identity = sorted(_canonical(c, {}) for c in self.checked)
+        found = []
+        for swap in candidates:
+            if swap in found:
+                continue
+            for var in swap:
+                if var not in values:
+                    domain = domains[var]
+                    if isinstance(domain, range) and domain.step < 0:
+                        domain = domain[::-1]
+                    values[var] = (
+                        domain if isinstance(domain, range) else sorted(domain)
+                    )
+            if any(values[x] != values[y] for x, y in swap.items()):
+                continue
+            keys = [_canonical(c, swap) for c in self.checked]
+            if None not in keys and sorted(keys) == identity:
+                found.append(swap)
+        return found
+
+    def break_symmetries(
+        self, domains: dict[Variable, Sequence[int]]
+    ) -> "CompiledTemplate":
+        """
+        Compile the template again with a constraint for each of its
+        symmetries() that keeps only the lexicographically smallest of the
+        solutions the swap links, by comparing the values of the swapped
+        variables in slot order. Every group of solutions that the swaps turn
+        into each other keeps at least one member, and exactly one when the
+        swaps touch disjoint sets of variables or all permute one set.
+
+        Args:
+            domains: Dictionary mapping Variable objects to their possible values.
+
+        Returns:
+            New template whose symmetry-breaking checks run first.
+        """
+        breaking = []
+        for swap in self.symmetries(domains):
+            pairs = [
+                (var, swap[var])
+                for var in self.variables
+                if var in swap and self.slots[var] < self.slots[swap[var]]
+            ]
+            breaking.append(
+                _LexLessOrEqual([x for x, _ in pairs], [y for _, y in pairs])
+            )
+        template = CompiledTemplate(self.variables, self.constraints + breaking)
+        n = len(self.constraints)
+        template.order_checks(list(range(n, n + len(breaking))) + self.check_order)
+        return template
+
+    def components(self) -> list["CompiledTemplate"]:
+        """
+        Split the template into groups of variables that share no constraint.
+
+        Constraints without variables belong to no group. The groups are
+        compiled once and the same templates returned by later calls.
+
+        Returns:
+            One template per connected component of the graph that links
+            variables used by the same constraint.
+        """
+        if self._components is not None:
+            return list(self._components)
+        parent = list(range(len(self.variables)))
+
+        def find(slot: int) -> int:
+            while parent[slot] != slot:
+                parent[slot] = parent[parent[slot]]
+                slot = parent[slot]
+            return slot
+
+        for needed, _ in self.checks:
+            linked = list(needed)
+            for slot in linked[1:]:
+                parent[find(slot)] = find(linked[0])
+
+        groups: dict[int, list[Variable]] = {}
+        for slot, var in enumerate(self.variables):
+            groups.setdefault(find(slot), []).append(var)
+        # List each group's constraints in the order their checks run, so
+        # the group's templates keep a learned check order.
+        rank = {position: r for r, position in enumerate(self.check_order)}
+        ranked = sorted(range(len(self.checks)), key=lambda i: rank[self.positions[i]])
+        self._components = [
+            CompiledTemplate(
+                group,
+                [
+                    self.checked[i]
+                    for i in ranked
+                    if self.checks[i][0]
+                    and self.variables[min(self.checks[i][0])] in group
+                ],
+            )
+            for group in groups.values()
+        ]
+        return list(self._components)
+
+    def propagate(
+        self,
+        domains: dict[Variable, Sequence[int]],
+        changed: Sequence[int] | None = None,
+        budget: int | None = _PROPAGATION_BUDGET,
+        limits: "_Budget | None" = None,
+    ) -> Constraint | None:
+        """
+        Narrow domains in place until no constraint can narrow them further.
+
+        Args:
+            domains: Dictionary mapping Variable objects to their possible values.
+            changed: Slots whose domains have changed since the domains were
+                last propagated, or None to propagate every constraint.
+            budget: Number of revisions allowed per constraint before giving
+                up on reaching a fixpoint (default=_PROPAGATION_BUDGET), or
+                None for as many revisions as reaching a fixpoint can take,
+                up to _FIXPOINT_BUDGET.
+            limits: Limits that stop the search with SearchTimeout, checked
+                before every revision.
+
+        Returns:
+            The constraint that can no longer be satisfied, or None if every
+            constraint may still be satisfied.
+        """
+        if changed is None:
+            pending = list(self.propagators)
+        else:
+            pending = list(
+                dict.fromkeys(
+                    i for slot in changed for i in self.propagator_watchers[slot]
+                )
+            )
+        queued = set(pending)
+        # Bounds can shrink by one value per pass between two constraints
+        # that feed each other, so stop after a fixed number of revisions.
+        if budget is None:
+            # After the first pass, a constraint is only revised again when
+            # a value of one of its variables is removed, and each removal
+            # queues the constraints watching that variable at most once.
+            values = sum(len(domains[var]) for var in self.variables)
+            watching = max(map(len, self.propagator_watchers), default=0)
+            budget = len(self.propagators) + values * watching
+            budget = min(budget, _FIXPOINT_BUDGET)
+        else:
+            budget *= len(self.propagators) + 1
+        while pending and budget:
+            budget -= 1
+            if limits is not None:
+                limits.check()
+            i = pending.pop(0)
+            queued.discard(i)
+            constraint = self.checked[i]
+            before = [domains[self.variables[slot]] for slot in self.checks[i][0]]
+            if not constraint.propagate(domains):
+                return constraint
+            for slot, domain in zip(self.checks[i][0], before):
+                if domains[self.variables[slot]] is domain:
+                    continue
+                for j in self.propagator_watchers[slot]:
+                    if j != i and j not in queued:
+                        pending.append(j)
+                        queued.add(j)
+        return None
+
+
+def compile_template(
+    variables: list[Variable], constraints: list[Constraint]
+) -> CompiledTemplate:
+    """
+    Compile a constraint satisfaction problem for fast solving.
+
+    Args:
+        variables: List of Variable objects to assign.
+        constraints: List of constraints that must be satisfied.
+
+    Returns:
+        CompiledTemplate whose constraint checks read from a slot array.
+    """
+    return CompiledTemplate(variables, constraints)
+
+
+class _SolutionSet:
+    """
+    Compact set of solutions, each packed into a single integer by writing
+    its slot values as the digits of a mixed-radix number.
+
+    Args:
+        template: Compiled variables and constraints being solved.
+        domains: Dictionary mapping Variable objects to their possible values.
+    """
+
+    def __init__(
+        self, template: CompiledTemplate, domains: dict[Variable, Sequence[int]]
+    ):
+        self.offsets = []
+        self.strides = []
+        stride = 1
+        for var in template.variables:
+            low, high = var.bounds(domains) or (0, 0)
+            self.offsets.append(low)
+            self.strides.append(stride)
+            stride *= high - low + 1
+        self.codes: set[int] = set()
+
+    def encode(self, slot_values: list[int]) -> int:
+        return sum(
+            (value - offset) * stride
+            for value, offset, stride in zip(slot_values, self.offsets, self.strides)
+        )
+
+    def add(self, slot_values: list[int]) -> None:
+        self.codes.add(self.encode(slot_values))
+
+    def __contains__(self, slot_values: list[int]) -> bool:
+        return self.encode(slot_values) in self.codes
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+
+class SearchTimeout(Exception):
+    """
+    Raised when a search runs out of time or nodes.
+
+    Args:
+        message: Description of the limit that was reached.
+        bindings: Solutions found before the search stopped.
+    """
+
+    def __init__(self, message: str, bindings: list | None = None):
+        super().__init__(message)
+        self.bindings = bindings if bindings is not None else []
+
+
+class _Cancelled(Exception):
+    """
+    Raised inside a search whose results are no longer wanted.
+    """
+
+
+# Number of values tried between checks of the clock against a deadline.
+_DEADLINE_INTERVAL = 64
+
+
+class _Budget:
+    """
+    Time and node limits shared by the searches of one call.
+
+    Args:
+        timeout: Seconds allowed from now, or None for no limit.
+        max_nodes: Search tree nodes allowed, or None for no limit.
+    """
+
+    def __init__(self, timeout: float | None, max_nodes: int | None):
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.max_nodes = max_nodes
+        self.nodes = 0
+        # Values tried, which is where the time goes.
+        self.steps = 0
+        # Set from another thread to stop the search at its next check.
+        self.cancelled = False
+
+    def spend(self) -> None:
+        """
+        Count a node, raising SearchTimeout once a limit is reached, or
+        _Cancelled once the search has been cancelled.
+        """
+        self.nodes += 1
+        if self.max_nodes is not None and self.nodes > self.max_nodes:
+            raise SearchTimeout(f"Search exceeded {self.max_nodes} nodes")
+        self.step()
+
+    def step(self) -> None:
+        """
+        Count a value tried, checking the limits every _DEADLINE_INTERVAL
+        values.
+        """
+        self.steps += 1
+        if self.steps % _DEADLINE_INTERVAL == 1:
+            self.check()
+
+    def check(self) -> None:
+        """
+        Raise SearchTimeout once the deadline has passed, or _Cancelled once
+        the search has been cancelled.
+        """
+        if self.cancelled:
+            raise _Cancelled("Search was cancelled")
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise SearchTimeout("Search ran out of time")
+
+
+class _NogoodStore:
+    """
+    Bounded store of nogoods: partial assignments, as sets of (slot, value)
+    pairs, that no solution extends. Each nogood is indexed by every pair in
+    it, and the least recently used nogood is evicted once the store is full.
+
+    Args:
+        capacity: Maximum number of nogoods to keep.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        # Dicts keep insertion order, so the first key is the least
+        # recently used nogood.
+        self.nogoods: dict[frozenset[tuple[int, int]], None] = {}
+        self.index: dict[tuple[int, int], set[frozenset[tuple[int, int]]]] = {}
+
+    def add(self, nogood: frozenset[tuple[int, int]]) -> None:
+        if nogood in self.nogoods:
+            del self.nogoods[nogood]
+            self.nogoods[nogood] = None
+            return
+        self.nogoods[nogood] = None
+        for pair in nogood:
+            self.index.setdefault(pair, set()).add(nogood)
+        if len(self.nogoods) > self.capacity:
+            oldest = next(iter(self.nogoods))
+            del self.nogoods[oldest]
+            for pair in oldest:
+                self.index[pair].discard(oldest)
+                if not self.index[pair]:
+                    del self.index[pair]
+
+    def violated(
+        self, slot: int, value: int, slot_values: list[int], assigned: list[bool]
+    ) -> frozenset[tuple[int, int]] | None:
+        """
+        Find a nogood that binding `slot` to `value` completes.
+
+        Returns:
+            The nogood, or None if the assignment completes none.
+        """
+        for nogood in self.index.get((slot, value), ()):
+            if all(assigned[s] and slot_values[s] == v for s, v in nogood):
+                del self.nogoods[nogood]
+                self.nogoods[nogood] = None
+                return nogood
+        return None
+
+    def __len__(self) -> int:
+        return len(self.nogoods)
+
+
+class _Search:
+    """
+    Iterative depth-first search over a compiled template.
+
+    The search keeps an explicit stack of (variable, remaining values) frames
+    instead of recursing, so it can be suspended after a solution and resumed
+    later to carry on from exactly where it stopped.
+
+    With propagation enabled, the constraints narrow the domains before the
+    search starts and again after each assignment, so values that cannot be
+    part of a solution are never tried. Narrowing keeps the domains' order.
+
+    The variable to assign next is chosen by `order`:
+
+    - "static": the order of the template's variables.
+    - "mrv": the variable with the fewest values left after propagation,
+      preferring variables in more constraints with unassigned variables.
+    - "degree": the variable in the most constraints with unassigned
+      variables, preferring variables with fewer values left.
+    - "domwdeg": the variable with the fewest values left per unit of
+      constraint weight, where a constraint's weight counts how often it
+      has failed during this search.
+
+    With consistency="arc" every constraint of one or two variables also
+    removes values that no value of the other variable supports before the
+    search starts, and with consistency="mac" this is repeated after each
+    assignment.
+
+    With backjumping enabled, a variable that runs out of values sends the
+    search straight back to the latest variable that helped rule its values
+    out, skipping the variables in between. The variables that ruled them
+    out form a nogood, which is remembered if a nogood store is given.
+
+    Args:
+        template: Compiled variables and constraints to solve.
+        domains: Dictionary mapping Variable objects to their possible values.
+        propagate: Narrow domains with the constraints' propagate() methods
+            (default=True).
+        exclude_zero: Skip the solution where every variable is 0
+            (default=True).
+        vectorize: Check the last variable's values as a NumPy array instead
+            of one at a time (default=False).
+        seen: Solutions to skip. Solutions are added as they are yielded.
+        order: How to choose the next variable (default="static").
+        consistency: "bounds", "arc" or "mac" (default="bounds").
+        backjump: Jump back to the cause of a dead end (default=False).
+        nogoods: Store for the nogoods learned while backjumping, shared
+            between searches of the same template and domains.
+        budget: Limits that stop the search with SearchTimeout.
+        share: Compute subexpressions shared by several checks once, when
+            their last variable is bound (default=True). Only for callers
+            that run every triggered check after binding a value.
+        propagated: The domains have already been propagated before the
+            search starts, by a caller that searches them repeatedly
+            (default=False).
+        exhausted: Partial assignments, as sets of (slot, value) pairs,
+            that no solution outside `seen` extends, shared between
+            searches that restart after each solution. Their subtrees are
+            skipped, and subtrees searched to the end are added.
+    """
+
+    def __init__(
+        self,
+        template: CompiledTemplate,
+        domains: dict[Variable, Sequence[int]],
+        propagate: bool = True,
+        exclude_zero: bool = True,
+        vectorize: bool = False,
+        seen: _SolutionSet | None = None,
+        order: str = "static",
+        consistency: str = "bounds",
+        backjump: bool = False,
+        nogoods: _NogoodStore | None = None,
+        budget: _Budget | None = None,
+        share: bool = True,
+        propagated: bool = False,
+        exhausted: set[frozenset[tuple[int, int]]] | None = None,
+    ):
+        if order not in _ORDERS:
+            raise ValueError(f"Unknown variable order: {order}")
+        if consistency not in _CONSISTENCIES:
+            raise ValueError(f"Unknown consistency: {consistency}")
+        self.template = template
+        self.propagating = propagate
+        self.exclude_zero = exclude_zero
+        self.seen = seen
+        self.exhausted = exhausted if seen is not None else None
+        # finished[depth] lists the subtrees below that depth's variable
+        # added to `exhausted`, which its own entry replaces once it is done.
+        self.finished: list[list[frozenset[tuple[int, int]]]] = []
+        self.order = order
+        self.consistency = consistency
+        # Residual supports kept between calls to arc_consistency().
+        self.supports: dict = {}
+        self.backjumping = backjump
+        self.nogoods = nogoods if backjump else None
+        self.budget = budget
+        self.sharing = share and bool(template.shared)
+        self.numpy = None
+        if vectorize:
+            try:
+                import numpy
+            except ImportError:
+                raise ImportError(
+                    "vectorize=True needs NumPy: pip install 'diceomatic[numpy]'"
+                ) from None
+            self.numpy = numpy
+
+        variables = template.variables
+        self.n = len(variables)
+        self.slot_values: list = [0] * self.n
+        self.stack: list[tuple] = []
+        self.assigned = [False] * self.n
+        # depths[slot] is the stack position of the variable in that slot.
+        self.depths = [0] * self.n
+        # conflicts[depth] holds the slots of the earlier variables that
+        # ruled out values at that depth, or None if they aren't known.
+        self.conflicts: list[set[int] | None] = []
+        # Each check is run exactly once per node: when the last of its
+        # variables is bound. unbound[i] counts the unbound variables of
+        # check i.
+        self.unbound = [len(needed) for needed, _ in template.checks]
+        # Likewise for the template's shared subexpressions.
+        self.shared_unbound = [len(needed) for needed, _ in template.shared]
+        # Failure counts for the "domwdeg" order.
+        self.failures = [1] * len(template.checks)
+
+        self.root_domains = {v: domains[v] for v in variables}
+        self.feasible = bool(self.n) and all(
+            check([]) for needed, check in template.checks if not needed
+        )
+        if self.feasible and propagate and not propagated:
+            self.feasible = (
+                template.propagate(self.root_domains, budget=None, limits=budget)
+                is None
+            )
+        if self.feasible and consistency != "bounds":
+            before = dict(self.root_domains)
+            self.feasible = (
+                template.arc_consistency(self.root_domains, None, self.supports, budget)
+                is None
+            )
+            changed = [
+                slot
+                for slot, var in enumerate(variables)
+                if self.root_domains[var] is not before[var]
+            ]
+            if self.feasible and propagate and changed:
+                self.feasible = (
+                    template.propagate(self.root_domains, changed, limits=budget)
+                    is None
+                )
+        # Directly solved values are looked up in the root domains. Any value
+        # that propagation removed deeper down fails a check anyway.
+        # Ranges already answer membership in constant time.
+        self.solvable_domains = {
+            slot: _range_of(self.root_domains[variables[slot]])
+            or set(self.root_domains[variables[slot]])
+            for _, slot in template.solvers
+        }
+
+    def push(self, slot: int, node_domains: dict[Variable, Sequence[int]]) -> None:
+        """
+        Start trying values for the variable in `slot`.
+        """
+        if self.budget is not None:
+            self.budget.spend()
+        template = self.template
+        computed = []
+        if self.sharing:
+            for k in template.shared_watchers[slot]:
+                self.shared_unbound[k] -= 1
+                if not self.shared_unbound[k]:
+                    computed.append(template.shared[k][1])
+        checks = template.fast_checks if self.sharing else template.plain_checks
+        triggered = []
+        values = None
+        # Checks that decided which values to try.
+        deciders: list[int] = []
+        for i in template.watchers[slot]:
+            self.unbound[i] -= 1
+            if not self.unbound[i]:
+                triggered.append(i)
+                if values is None and (i, slot) in template.solvers:
+                    values = template.solvers[(i, slot)](self.slot_values)
+                    deciders = [i]
+        var = template.variables[slot]
+        if values is None:
+            values = node_domains[var]
+            if self.numpy and len(self.stack) == self.n - 1 and len(values) > 1:
+                filtered = self.filter_array(slot, values, triggered)
+                if filtered is not None:
+                    values, triggered, deciders = filtered, [], triggered
+                    computed = []
+        elif values and values[0] not in self.solvable_domains[slot]:
+            values = []
+        if self.backjumping:
+            # Values removed by propagation could have been removed because
+            # of any earlier variable.
+            if node_domains[var] is not self.root_domains[var]:
+                self.conflicts.append(None)
+            else:
+                self.conflicts.append(
+                    {s for i in deciders for s in template.checks[i][0]} - {slot}
+                )
+        # Shared subexpressions are computed before the checks that use them.
+        triggered_checks = computed + [checks[i] for i in triggered]
+        self.depths[slot] = len(self.stack)
+        self.assigned[slot] = True
+        if self.exhausted is not None:
+            self.finished.append([])
+        self.stack.append(
+            (slot, iter(values), triggered_checks, node_domains, triggered)
+        )
+
+    def pop(self) -> None:
+        """
+        Give up on the variable at the top of the stack.
+        """
+        slot = self.stack.pop()[0]
+        self.assigned[slot] = False
+        if self.sharing:
+            for k in self.template.shared_watchers[slot]:
+                self.shared_unbound[k] += 1
+        if self.backjumping:
+            self.conflicts.pop()
+        if self.exhausted is not None:
+            self.finished.pop()
+        for i in self.template.watchers[slot]:
+            self.unbound[i] += 1
+
+    def assignment(self) -> frozenset[tuple[int, int]]:
+        """
+        Return the (slot, value) pairs of the variables on the stack.
+        """
+        return frozenset((frame[0], self.slot_values[frame[0]]) for frame in self.stack)
+
+    def finish(self) -> None:
+        """
+        Pop the variable at the top of the stack once all of its values have
+        been tried, recording that no new solution extends the assignment of
+        the variables left on the stack.
+        """
+        if self.exhausted is None:
+            self.pop()
+            return
+        children = self.finished[-1]
+        self.pop()
+        self.exhausted.difference_update(children)
+        done = self.assignment()
+        self.exhausted.add(done)
+        if self.finished:
+            self.finished[-1].append(done)
+
+    def select(self, node_domains: dict[Variable, Sequence[int]]) -> int:
+        """
+        Choose the slot of the next variable to assign.
+        """
+        if self.order == "static":
+            return len(self.stack)
+
+        variables = self.template.variables
+        watchers = self.template.watchers
+        unbound = self.unbound
+        best_slot, best_key = -1, None
+        for slot in range(self.n):
+            if self.assigned[slot]:
+                continue
+            size = len(node_domains[variables[slot]])
+            if self.order == "domwdeg":
+                weight = sum(self.failures[i] for i in watchers[slot] if unbound[i] > 1)
+                key = (size / weight if weight else math.inf, size)
+            else:
+                degree = sum(1 for i in watchers[slot] if unbound[i] > 1)
+                key = (size, -degree) if self.order == "mrv" else (-degree, size)
+            if best_key is None or key < best_key:
+                best_slot, best_key = slot, key
+        return best_slot
+
+    def fail(self, triggered: list[int]) -> None:
+        """
+        Record that one of the triggered checks rejected a value.
+        """
+        if self.order != "domwdeg":
+            return
+        checks = self.template.checks
+        for i in triggered:
+            if not checks[i][1](self.slot_values):
+                self.failures[i] += 1
+                return
+
+    def filter_array(
+        self, slot: int, values: Sequence[int], triggered: list[int]
+    ) -> list[int] | None:
+        """
+        Check every value of the last variable at once, unless a check can't
+        take arrays or might overflow 64-bit integers.
+        """
+        numpy = self.numpy
+        slot_values = self.slot_values
+        magnitudes = [self.template.magnitudes[i] for i in triggered]
+        if any(m is None for m in magnitudes):
+            return None
+        largest = max(
+            [abs(v) for i, v in enumerate(slot_values) if i != slot]
+            + [abs(min(values)), abs(max(values)), 1]
+            + [m[2] for m in magnitudes]
+        )
+        if any(
+            count * largest**degree >= _VECTORIZE_LIMIT
+            for count, degree, _ in magnitudes
+        ):
+            return None
+
+        array = numpy.asarray(values, dtype=numpy.int64)
+        slot_values[slot] = array
+        mask = numpy.ones(len(array), dtype=bool)
+        try:
+            with numpy.errstate(divide="raise"):
+                for i in triggered:
+                    mask &= self.template.checks[i][1](slot_values)
+        except FloatingPointError:
+            # Let the scalar checks raise ZeroDivisionError as usual.
+            return None
+        finally:
+            slot_values[slot] = 0
+        return array[mask].tolist()
+
+    def descend(
+        self, slot: int, value: int, node_domains: dict[Variable, Sequence[int]]
+    ) -> dict[Variable, Sequence[int]] | None:
+        """
+        Narrow the domains below a node after binding `slot` to `value`.
+
+        Returns:
+            The child node's domains, or None if propagation shows that no
+            solution extends the current assignment.
+        """
+        template = self.template
+        # Once a single variable is left, trying its values directly is
+        # cheaper than narrowing its domain first.
+        if len(self.stack) >= self.n - 1:
+            return node_domains
+        propagate = self.propagating and template.propagator_watchers[slot]
+        maintain = self.consistency == "mac" and template.arc_watchers[slot]
+        if not propagate and not maintain:
+            return node_domains
+        child_domains = dict(node_domains)
+        child_domains[template.variables[slot]] = [value]
+        failed = None
+        if propagate:
+            failed = template.propagate(child_domains, (slot,), limits=self.budget)
+        if failed is None and maintain:
+            changed = [
+                slot
+                for slot, var in enumerate(template.variables)
+                if child_domains[var] is not node_domains[var]
+            ]
+            failed = template.arc_consistency(
+                child_domains, changed, self.supports, self.budget
+            )
+        if failed is not None:
+            if self.order == "domwdeg":
+                self.failures[template.check_index[id(failed)]] += 1
+            return None
+        return child_domains
+
+    def solutions(self) -> Generator[list[int], None, None]:
+        """
+        Yield every solution in turn.
+
+        Yields:
+            The slot array holding the solution. It is reused by the search,
+            so copy it before resuming the generator.
+        """
+        if not self.feasible:
+            return
+        exhausted = self.exhausted
+        if exhausted is not None and frozenset() in exhausted:
+            return
+        if self.backjumping:
+            yield from self.backjumping_solutions()
+            return
+        n = self.n
+        stack = self.stack
+        slot_values = self.slot_values
+        budget = self.budget
+        self.push(self.select(self.root_domains), self.root_domains)
+        while stack:
+            slot, values, triggered, node_domains, triggered_ids = stack[-1]
+            for value in values:
+                if budget is not None:
+                    budget.step()
+                slot_values[slot] = value
+                if not all(check(slot_values) for check in triggered):
+                    self.fail(triggered_ids)
+                    continue
+                if len(stack) == n:
+                    if self.exclude_zero and not any(slot_values):
+                        continue
+                    if self.seen is not None:
+                        if slot_values in self.seen:
+                            continue
+                        self.seen.add(slot_values)
+                    yield slot_values
+                    continue
+                if exhausted is not None and self.assignment() in exhausted:
+                    continue
+                child_domains = self.descend(slot, value, node_domains)
+                if child_domains is None:
+                    continue
+                self.push(self.select(child_domains), child_domains)
+                break
+            else:
+                # This variable's values are exhausted: the parent moves on
+                # to its next value.
+                self.finish()
+
+    def backjumping_solutions(self) -> Generator[list[int], None, None]:
+        """
+        Yield every solution in turn, jumping back over variables that had
+        nothing to do with a dead end.
+
+        Yields:
+            The slot array holding the solution. It is reused by the search,
+            so copy it before resuming the generator.
+        """
+        n = self.n
+        stack = self.stack
+        slot_values = self.slot_values
+        checks = self.template.checks
+        conflicts = self.conflicts
+        nogoods = self.nogoods
+        budget = self.budget
+        exhausted = self.exhausted
+
+        def blame(depth: int, slot: int, culprits: Iterable[int]) -> None:
+            if conflicts[depth] is not None:
+                conflicts[depth].update(s for s in culprits if s != slot)
+
+        self.push(self.select(self.root_domains), self.root_domains)
+        while stack:
+            slot, values, _, node_domains, triggered_ids = stack[-1]
+            depth = len(stack) - 1
+            for value in values:
+                if budget is not None:
+                    budget.step()
+                slot_values[slot] = value
+                failed = next(
+                    (i for i in triggered_ids if not checks[i][1](slot_values)), None
+                )
+                if failed is not None:
+                    if self.order == "domwdeg":
+                        self.failures[failed] += 1
+                    blame(depth, slot, checks[failed][0])
+                    continue
+                if nogoods is not None:
+                    nogood = nogoods.violated(slot, value, slot_values, self.assigned)
+                    if nogood is not None:
+                        blame(depth, slot, (s for s, _ in nogood))
+                        continue
+                if len(stack) == n:
+                    # Solutions, and skipped solutions, depend on every
+                    # variable, so nothing can be jumped over from here.
+                    conflicts[depth] = None
+                    if self.exclude_zero and not any(slot_values):
+                        continue
+                    if self.seen is not None:
+                        if slot_values in self.seen:
+                            continue
+                        self.seen.add(slot_values)
+                    yield slot_values
+                    continue
+                if exhausted is not None and self.assignment() in exhausted:
+                    # The subtree holds solutions that were skipped.
+                    conflicts[depth] = None
+                    continue
+                child_domains = self.descend(slot, value, node_domains)
+                if child_domains is None:
+                    conflicts[depth] = None
+                    continue
+                self.push(self.select(child_domains), child_domains)
+                break
+            else:
+                conflict = conflicts[depth]
+                if conflict is None:
+                    self.finish()
+                    if stack:
+                        conflicts[-1] = None
+                    continue
+                if not conflict:
+                    # No earlier assignment is to blame, so there are no
+                    # more solutions.
+                    while stack:
+                        self.finish()
+                    return
+                if nogoods is not None:
+                    nogoods.add(frozenset((s, slot_values[s]) for s in conflict))
+                target = max(self.depths[s] for s in conflict)
+                while len(stack) > target + 1:
+                    self.pop()
+                blame(target, stack[-1][0], conflict)
+
+    def count(self) -> int:
+        """
+        Count the solutions without building them.
+
+        The last variable's values are counted in a tight loop, and a
+        directly solved last variable costs a single check.
+
+        Returns:
+            Number of solutions.
+        """
+        if not self.feasible:
+            return 0
+        n = self.n
+        stack = self.stack
+        slot_values = self.slot_values
+        budget = self.budget
+        total = 0
+        if n == 1:
+            self.push(0, self.root_domains)
+            total = self.count_last()
+            self.pop()
+            return total
+
+        self.push(self.select(self.root_domains), self.root_domains)
+        while stack:
+            slot, values, triggered, node_domains, triggered_ids = stack[-1]
+            for value in values:
+                if budget is not None:
+                    budget.step()
+                slot_values[slot] = value
+                if not all(check(slot_values) for check in triggered):
+                    self.fail(triggered_ids)
+                    continue
+                child_domains = self.descend(slot, value, node_domains)
+                if child_domains is None:
+                    continue
+                if len(stack) == n - 1:
+                    self.push(self.select(child_domains), child_domains)
+                    total += self.count_last()
+                    self.pop()
+                    continue
+                self.push(self.select(child_domains), child_domains)
+                break
+            else:
+                self.pop()
+        return total
+
+    def count_last(self) -> int:
+        """
+        Count the values of the variable at the top of the stack that pass
+        its checks, given that every other variable is bound.
+        """
+        slot, values, triggered, _, _ = self.stack[-1]
+        slot_values = self.slot_values
+        # With every other variable at 0, a value of 0 would complete the
+        # excluded all-zero assignment.
+        skip_zero = self.exclude_zero and not any(
+            v for i, v in enumerate(slot_values) if i != slot
+        )
+        budget = self.budget
+        total = 0
+        for value in values:
+            if budget is not None:
+                budget.step()
+            if skip_zero and value == 0:
+                continue
+            slot_values[slot] = value
+            if all(check(slot_values) for check in triggered):
+                total += 1
+        return total
+
+
+def _search(
+    template: CompiledTemplate,
+    domains: dict[Variable, list[int]],
+    propagate: bool = True,
+    exclude_zero: bool = True,
+    vectorize: bool = False,
+    seen: _SolutionSet | None = None,
+    order: str = "static",
+    consistency: str = "bounds",
+    backjump: bool = False,
+    nogoods: _NogoodStore | None = None,
+    budget: _Budget | None = None,
+    propagated: bool = False,
+    exhausted: set[frozenset[tuple[int, int]]] | None = None,
+) -> Generator[dict[Variable, int], None, None]:
+    """
+    Iterative depth-first search that yields every solution in turn.
+
+    Args:
+        template: Compiled variables and constraints to solve.
+        domains: Dictionary mapping Variable objects to their possible values.
+        propagate: Narrow domains with the constraints' propagate() methods
+            (default=True).
+        exclude_zero: Skip the solution where every variable is 0
+            (default=True).
+        vectorize: Check the last variable's values as a NumPy array instead
+            of one at a time (default=False).
+        seen: Solutions to skip. Solutions are added as they are yielded.
+        order: How to choose the next variable (default="static").
+        consistency: "bounds", "arc" or "mac" (default="bounds").
+        backjump: Jump back to the cause of a dead end (default=False).
+        nogoods: Store for the nogoods learned while backjumping.
+        budget: Limits that stop the search with SearchTimeout.
+        propagated: The domains have already been propagated
+            (default=False).
+        exhausted: Partial assignments that no solution outside `seen`
+            extends, shared between restarts.
+
+    Yields:
+        Dictionary mapping variables to values that satisfies all constraints.
+    """
+    search = _Search(
+        template,
+        domains,
+        propagate,
+        exclude_zero,
+        vectorize,
+        seen,
+        order,
+        consistency,
+        backjump,
+        nogoods,
+        budget,
+        propagated=propagated,
+        exhausted=exhausted,
+    )
+    for slot_values in search.solutions():
+        yield dict(zip(template.variables, slot_values))
+
+
+class _Sampler:
+    """
+    Draws solutions uniformly at random from the whole solution space.
+
+    Every value at every level of the search tree is weighted by the number
+    of solutions below it, so a solution in a sparse part of the tree is as
+    likely as one in a dense part. The weights of the upper levels are
+    counted once and cached, so later samples only count the lower levels
+    along the path they take.
+
+    Solutions can be removed from the space, which is how the all-zero
+    assignment is excluded and how sampling without replacement works.
+
+    Args:
+        template: Compiled variables and constraints to solve.
+        domains: Dictionary mapping Variable objects to their possible values.
+        unique: Never draw the same solution twice (default=False).
+        exclude_zero: Never draw the solution where every variable is 0
+            (default=True).
+        budget: Limits that stop sampling with SearchTimeout.
+        propagated: The domains have already been propagated
+            (default=False).
+    """
+
+    def __init__(
+        self,
+        template: CompiledTemplate,
+        domains: dict[Variable, Sequence[int]],
+        unique: bool = False,
+        exclude_zero: bool = True,
+        budget: _Budget | None = None,
+        propagated: bool = False,
+    ):
+        # Samples move down the tree without trying every value, so shared
+        # subexpressions wouldn't be kept up to date.
+        self.search = _Search(
+            template,
+            domains,
+            exclude_zero=False,
+            budget=budget,
+            share=False,
+            propagated=propagated,
+        )
+        self.n = self.search.n
+        self.unique = unique
+        self.exclude_zero = exclude_zero
+        self.removed = _SolutionSet(template, domains)
+        # Maps an assigned prefix of slot values to the (value, count) pairs
+        # for the next slot.
+        self.weights: dict[tuple, list[tuple[int, int]]] = {}
+
+    def children(
+        self, depth: int, node_domains: dict[Variable, Sequence[int]]
+    ) -> list[tuple[int, int]]:
+        """
+        Start on the slot at `depth` and weight each of its values by the
+        number of solutions below it. The caller must pop the search frame.
+        """
+        search = self.search
+        slot_values = search.slot_values
+        search.push(depth, node_domains)
+        prefix = tuple(slot_values[:depth])
+        if prefix in self.weights:
+            return self.weights[prefix]
+
+        slot, values, triggered, _, _ = search.stack[-1]
+        budget = search.budget
+        weights = []
+        for value in values:
+            if budget is not None:
+                budget.step()
+            slot_values[slot] = value
+            if not all(check(slot_values) for check in triggered):
+                continue
+            if depth == self.n - 1:
+                if slot_values not in self.removed:
+                    weights.append((value, 1))
+                continue
+            child_domains = search.descend(slot, value, node_domains)
+            if child_domains is None:
+                continue
+            count = sum(c for _, c in self.children(depth + 1, child_domains))
+            search.pop()
+            if count:
+                weights.append((value, count))
+        if depth < self.n - 1 and len(self.weights) < _SAMPLER_CACHE_SIZE:
+            self.weights[prefix] = weights
+        return weights
+
+    def sample(self) -> list[int] | None:
+        """
+        Draw a solution.
+
+        Returns:
+            The slot values of the solution, or None if there is none.
+        """
+        search = self.search
+        if not search.feasible:
+            return None
+        while True:
+            node_domains = search.root_domains
+            for depth in range(self.n):
+                weights = self.children(depth, node_domains)
+                if not weights:
+                    break
+                value = random.choices(
+                    [v for v, _ in weights], [c for _, c in weights]
+                )[0]
+                search.slot_values[depth] = value
+                if depth < self.n - 1:
+                    node_domains = search.descend(depth, value, node_domains)
+            solution = list(search.slot_values)
+            while search.stack:
+                search.pop()
+            if not weights:
+                return None
+            # The all-zero assignment is never a solution.
+            if self.exclude_zero and not any(solution):
+                self.remove(solution)
+                continue
+            if self.unique:
+                self.remove(solution)
+            return solution
+
+    def size(self) -> int:
+        """
+        Count the solutions left to draw.
+        """
+        search = self.search
+        if not search.feasible:
+            return 0
+        weights = self.children(0, search.root_domains)
+        while search.stack:
+            search.pop()
+        return sum(count for _, count in weights)
+
+    def remove(self, solution: list[int]) -> None:
+        """
+        Take a solution out of the space, updating the cached weights along
+        its path.
+        """
+        self.removed.add(solution)
+        for depth in range(self.n - 1):
+            weights = self.weights.get(tuple(solution[:depth]))
+            if weights is None:
+                continue
+            for i, (value, count) in enumerate(weights):
+                if value == solution[depth]:
+                    if count > 1:
+                        weights[i] = (value, count - 1)
+                    else:
+                        del weights[i]
+                    break
+
+
+# Variable orders supported by _Search.
+_ORDERS = ("static", "mrv", "degree", "domwdeg")
+
+# Levels of consistency supported by _Search.
+_CONSISTENCIES = ("bounds", "arc", "mac")
+
+# Maximum number of search tree nodes whose weights _Sampler caches.
+_SAMPLER_CACHE_SIZE = 100_000
+
+
+def _sum_terms(value: Value) -> list[Value]:
+    """
+    Split a value expression into the terms of its top-level additions.
+
+    Args:
+        value: Value expression to split.
+
+    Returns:
+        List of terms that add up to the expression.
+    """
+    if isinstance(value, Add):
+        return _sum_terms(value.operand1) + _sum_terms(value.operand2)
+    return [value]
+
+
+def _join_plan(template: CompiledTemplate) -> tuple[Value, Value, Value] | None:
+    """
+    Look for an Equal constraint that can be solved as a hash join: one side
+    is a sum whose terms split into two groups that share no variables with
+    each other or with the other side.
+
+    Args:
+        template: Compiled variables and constraints to solve.
+
+    Returns:
+        (left, right, total) expressions such that left + right = total must
+        hold, or None if no constraint has that shape.
+    """
+    for constraint in template.checked:
+        if not isinstance(constraint, Equal):
+            continue
+        for total, other in (
+            (constraint.operand1, constraint.operand2),
+            (constraint.operand2, constraint.operand1),
+        ):
+            # Group the terms that share variables, so that the groups are
+            # independent of each other.
+            groups: list[tuple[set[Variable], list[Value]]] = []
+            for term in _sum_terms(total):
+                term_vars = set(term.variables())
+                terms = [term]
+                for group in [g for g in groups if g[0] & term_vars]:
+                    groups.remove(group)
+                    term_vars |= group[0]
+                    terms = group[1] + terms
+                groups.append((term_vars, terms))
+            other_vars = set(other.variables())
+            groups = [g for g in groups if g[0]]
+            if len(groups) < 2 or any(g[0] & other_vars for g in groups):
+                continue
+
+            # Balance the two sides by number of variables, since each side's
+            # table grows with the product of its variables' domain sizes.
+            sides: tuple[list[Value], list[Value]] = ([], [])
+            sizes = [0, 0]
+            for group_vars, terms in sorted(groups, key=lambda g: -len(g[0])):
+                side = 0 if sizes[0] <= sizes[1] else 1
+                sides[side].extend(terms)
+                sizes[side] += len(group_vars)
+            constant_terms = [t for t in _sum_terms(total) if not t.variables()]
+            left, right = sides[0] + constant_terms, sides[1]
+            return _add_all(left), _add_all(right), other
+    return None
+
+
+def _add_all(terms: list[Value]) -> Value:
+    """
+    Build the sum of a non-empty list of value expressions.
+    """
+    total = terms[0]
+    for term in terms[1:]:
+        total = Add(total, term)
+    return total
+
+
+def _join(
+    template: CompiledTemplate,
+    domains: dict[Variable, list[int]],
+    plan: tuple[Value, Value, Value],
+    budget: _Budget | None = None,
+    propagated: bool = False,
+) -> Generator[dict[Variable, int], None, None]:
+    """
+    Hash-join solver that yields every solution in turn.
+
+    For a plan left + right = total, the solutions of the constraints over
+    the left variables alone are tabulated by the value of `left`, and
+    likewise for `right`. Each solution for the remaining variables then
+    fixes `total`, and the matching rows are found by looking up
+    total - left_value in the right-hand table, instead of searching the
+    product of both sides.
+
+    Args:
+        template: Compiled variables and constraints to solve.
+        domains: Dictionary mapping Variable objects to their possible values.
+        plan: (left, right, total) expressions found by _join_plan.
+        budget: Limits that stop the search with SearchTimeout.
+        propagated: The domains have already been propagated
+            (default=False).
+
+    Yields:
+        Dictionary mapping variables to values that satisfies all constraints.
+    """
+    left, right, total = plan
+    variables = template.variables
+    root_domains = {v: domains[v] for v in variables}
+    if (
+        not propagated
+        and template.propagate(root_domains, budget=None, limits=budget) is not None
+    ):
+        return
+
+    def part(value_vars: set[Variable]) -> CompiledTemplate:
+        part_vars = [v for v in variables if v in value_vars]
+        return CompiledTemplate(
+            part_vars,
+            [c for c in template.checked if value_vars.issuperset(c.variables())],
+        )
+
+    def table(value: Value) -> dict[int, list[dict[Variable, int]]]:
+        value_part = part(set(value.variables()))
+        rows: dict[int, list[dict[Variable, int]]] = {}
+        rows_found = _search(
+            value_part,
+            root_domains,
+            exclude_zero=False,
+            budget=budget,
+            propagated=True,
+        )
+        for row in rows_found:
+            rows.setdefault(value.evaluate(row), []).append(row)
+        return rows
+
+    left_rows = table(left)
+    right_rows = table(right)
+    if not left_rows or not right_rows:
+        return
+
+    joined_vars = set(left.variables()) | set(right.variables())
+    rest = part(set(variables) - joined_vars)
+    if rest.variables:
+        rest_rows = _search(
+            rest, root_domains, exclude_zero=False, budget=budget, propagated=True
+        )
+    else:
+        rest_rows = iter([{}])
+
+    # The constraints within each part have already been checked.
+    parts = [set(left.variables()), set(right.variables()), set(rest.variables)]
+    cross_checks = [
+        check
+        for (needed, check), constraint in zip(template.checks, template.checked)
+        if not any(p.issuperset(constraint.variables()) for p in parts)
+    ]
+
+    slot_values = [0] * len(variables)
+    for rest_row in rest_rows:
+        target = total.evaluate(rest_row)
+        for left_value, left_matches in left_rows.items():
+            if budget is not None:
+                budget.step()
+            right_matches = right_rows.get(target - left_value)
+            if not right_matches:
+                continue
+            for left_row in left_matches:
+                for right_row in right_matches:
+                    if budget is not None:
+                        budget.step()
+                    solution = {**rest_row, **left_row, **right_row}
+                    for var, value in solution.items():
+                        slot_values[template.slots[var]] = value
+                    if not all(check(slot_values) for check in cross_checks):
+                        continue
+                    if not all(v == 0 for v in slot_values):
+                        yield {v: solution[v] for v in variables}
+
+
+def gen_bindings(
+    variables: list[Variable],
+    domains: dict[Variable, list[int]],
+    constraints: list[Constraint],
+    resume: bool = False,
+    engine: str = "backtrack",
+    vectorize: bool = False,
+    uniform: bool = False,
+    unique: bool = False,
+    order: str = "static",
+    check_order: Sequence[int] | None = None,
+    consistency: str = "bounds",
+    backjump: bool = False,
+    max_nogoods: int = 0,
+    timeout: float | None = None,
+    max_nodes: int | None = None,
+    break_symmetry: bool = False,
+) -> Generator[dict[Variable, int], None, None]:
+    """
+    Generate solutions to a constraint satisfaction problem.
+
+    By default every solution comes from a fresh search over reshuffled
+    domains. With resume=True the domains are shuffled once and the search
+    carries on from the previous solution, so each solution costs only the
+    work needed to reach the next leaf. Once every solution has been produced
+    the domains are reshuffled and the search starts again.
+
+    The "join" engine solves templates such as A*B + C*D = E by tabulating
+    A*B and C*D separately and joining the tables on E, which turns a search
+    over four variables into two searches over two. It always resumes, and
+    needs an Equal between a sum of independent subexpressions and a value
+    that shares none of their variables.
+
+    With vectorize=True the backtracking engine checks all of the last
+    variable's values at once with NumPy, which must be installed.
+
+    The search favours solutions in dense parts of the search tree. With
+    uniform=True every solution is equally likely instead: the solutions
+    below each value are counted once, and each solution is drawn by
+    following the counts down the tree. This ignores resume and engine.
+
+    Groups of variables that share no constraint are searched or sampled
+    separately and their solutions combined. This is skipped when every
+    variable can be 0, and when unique=True is combined with uniform=True or
+    used without resume=True, since those need to see whole solutions.
+
+    With unique=True no solution is produced twice, and the generator stops
+    once every solution has been produced. Produced solutions are skipped
+    during the search rather than filtered afterwards.
+
+    The backtracking engine assigns variables in the order given unless
+    `order` picks them dynamically: "mrv" takes the variable with the fewest
+    values left, "degree" the one in the most open constraints, and
+    "domwdeg" weighs the values left against how often the variable's
+    constraints have failed. Constraints that become decidable together are
+    checked in declaration order unless `check_order` lists their positions
+    in another order, such as one learned by
+    CompiledTemplate.learn_check_order().
+
+    The constraints always narrow the bounds of the variables' domains. With
+    consistency="arc" the backtracking engine also removes every value that
+    has no partner in a constraint of two variables before searching, and
+    with consistency="mac" it does so again after each assignment. Templates
+    that turn out to have no solution end the search at once.
+
+    With backjump=True a variable that runs out of values sends the
+    backtracking engine straight back to the latest variable that helped
+    rule them out. Each such dead end is a nogood: a set of values that no
+    solution contains. With max_nogoods above 0 up to that many nogoods are
+    remembered for the rest of the stream, so restarted searches don't run
+    into the same dead ends again.
+
+    timeout and max_nodes limit the seconds and search tree nodes the whole
+    stream may use, counted from the first solution requested. Once either
+    runs out the stream stops with SearchTimeout. The time taken to produce
+    each solution feeds the template's latency_estimate().
+
+    With break_symmetry=True, variables that can be swapped without changing
+    the constraints, such as A and B in A*B, are found with
+    CompiledTemplate.symmetries() and constrained so that only one of the
+    solutions the swaps link is produced: 3*4 but not 4*3. Combined with
+    unique=True this generates every question that is really different once.
+
+    Args:
+        variables: List of Variable objects to assign.
+        domains: Dictionary mapping Variable objects to their possible values.
+        constraints: List of constraints that must be satisfied.
+        resume: Continue the previous search instead of restarting it for
+            every solution (default=False).
+        engine: "backtrack" or "join" (default="backtrack").
+        vectorize: Check the last variable's values with NumPy (default=False).
+        uniform: Draw every solution with equal probability (default=False).
+        unique: Never produce the same solution twice (default=False).
+        order: "static", "mrv", "degree" or "domwdeg" (default="static").
+        check_order: Positions in `constraints` in the order to check them
+            (default=None, declaration order).
+        consistency: "bounds", "arc" or "mac" (default="bounds").
+        backjump: Jump back to the cause of a dead end (default=False).
+        max_nogoods: Number of nogoods to remember while backjumping
+            (default=0).
+        timeout: Seconds the stream may search for (default=None, no limit).
+        max_nodes: Search tree nodes the stream may visit (default=None,
+            no limit).
+        break_symmetry: Produce one solution of each group of solutions that
+            swapping interchangeable variables links (default=False).
+
+    Yields:
+        Dictionary mapping variables to values that satisfies all constraints.
+
+    Raises:
+        ValueError: If the engine, order or consistency is unknown, or the
+            engine can't solve the constraints.
+        SearchTimeout: If the stream runs out of time or nodes.
+    """
+    budget = None
+    if timeout is not None or max_nodes is not None:
+        budget = _Budget(timeout, max_nodes)
+    solutions = _generate(
+        variables,
+        domains,
+        constraints,
+        resume,
+        engine,
+        vectorize,
+        uniform,
+        unique,
+        order,
+        check_order,
+        consistency,
+        backjump,
+        max_nogoods,
+        budget,
+        break_symmetry,
+    )
+    yield from _measure(variables, constraints, solutions)
+
+
+def _measure(
+    variables: list[Variable],
+    constraints: list[Constraint],
+    solutions: Iterable[dict[Variable, int]],
+) -> Generator[dict[Variable, int], None, None]:
+    """
+    Pass solutions through, recording the time each took in the template's
+    latency estimate.
+    """
+    latency = _latency(variables, constraints)
+    start = time.perf_counter()
+    try:
+        for solution in solutions:
+            latency.record(time.perf_counter() - start)
+            yield solution
+            start = time.perf_counter()
+    except SearchTimeout:
+        # The time spent is a lower bound on the time the solution needed.
+        latency.record(time.perf_counter() - start)
+        raise
+
+
+async def agen_bindings(
+    variables: list[Variable],
+    domains: dict[Variable, list[int]],
+    constraints: list[Constraint],
+    resume: bool = False,
+    engine: str = "backtrack",
+    vectorize: bool = False,
+    uniform: bool = False,
+    unique: bool = False,
+    order: str = "static",
+    check_order: Sequence[int] | None = None,
+    consistency: str = "bounds",
+    backjump: bool = False,
+    max_nogoods: int = 0,
+    timeout: float | None = None,
+    max_nodes: int | None = None,
+    break_symmetry: bool = False,
+) -> AsyncGenerator[dict[Variable, int], None]:
+    """
+    Generate solutions like gen_bindings(), without blocking the event loop.
+
+    Each solution is searched for in the event loop's default executor, so
+    other tasks keep running while the search does. When the consuming task
+    is cancelled, or the generator is closed, the search running in the
+    executor stops at its next node instead of running on in the
+    background.
+
+    Takes the same arguments as gen_bindings().
+
+    Yields:
+        Dictionary mapping variables to values that satisfies all constraints.
+
+    Raises:
+        ValueError: If the engine, order or consistency is unknown, or the
+            engine can't solve the constraints.
+        SearchTimeout: If the stream runs out of time or nodes.
+    """
+    # The budget is how the search notices that it has been cancelled.
+    budget = _Budget(timeout, max_nodes)
+    solutions = _generate(
+        variables,
+        domains,
+        constraints,
+        resume,
+        engine,
+        vectorize,
+        uniform,
+        unique,
+        order,
+        check_order,
+        consistency,
+        backjump,
+        max_nogoods,
+        budget,
+        break_symmetry,
+    )
+    measured = _measure(variables, constraints, solutions)
+    loop = asyncio.get_running_loop()
+    finished = object()
+    try:
+        while True:
+            solution = await loop.run_in_executor(None, next, measured, finished)
+            if solution is finished:
+                return
+            yield solution
+    finally:
+        budget.cancelled = True
+
+
+def _generate(
+    variables: list[Variable],
+    domains: dict[Variable, list[int]],
+    constraints: list[Constraint],
+    resume: bool,
+    engine: str,
+    vectorize: bool,
+    uniform: bool,
+    unique: bool,
+    order: str,
+    check_order: Sequence[int] | None,
+    consistency: str,
+    backjump: bool,
+    max_nogoods: int,
+    budget: _Budget | None,
+    break_symmetry: bool,
+) -> Generator[dict[Variable, int], None, None]:
+    """
+    Generate solutions as described by gen_bindings().
+    """
+    template = compile_template(variables, constraints)
+    if check_order is not None:
+        template.order_checks(check_order)
+    # Ranges are kept as they are, since they hold no duplicates and are
+    # shuffled lazily.
+    if unique:
+        domains_copy = {
+            var: d if isinstance(d, range) else list(dict.fromkeys(d))
+            for var, d in domains.items()
+        }
+    else:
+        domains_copy = {
+            var: d if isinstance(d, range) else list(d) for var, d in domains.items()
+        }
+    if break_symmetry:
+        template = template.break_symmetries(domains_copy)
+    # Narrow the domains once for the whole stream rather than every time
+    # the search restarts: reaching a fixpoint can take a revision per value.
+    if not all(check([]) for needed, check in template.checks if not needed):
+        return
+    if template.propagate(domains_copy, budget=None, limits=budget) is not None:
+        return
+
+    # Groups of variables that share no constraint are solved separately,
+    # and their solutions combined, skipping the all-zero combination.
+    # Restarting for every solution without repeating one has to search
+    # whole solutions: a restarted odometer would combine the same first
+    # solutions of the groups every time.
+    components = template.components()
+    if len(components) < 2 or (unique and not resume):
+        components = []
+
+    if uniform:
+        if components and not unique:
+            samplers = [
+                _Sampler(
+                    component,
+                    domains_copy,
+                    exclude_zero=False,
+                    budget=budget,
+                    propagated=True,
+                )
+                for component in components
+            ]
+            while True:
+                parts = [sampler.sample() for sampler in samplers]
+                if None in parts:
+                    break
+                # Drawing again leaves the other combinations equally likely.
+                if not any(any(part) for part in parts):
+                    if all(sampler.size() == 1 for sampler in samplers):
+                        break
+                    continue
+                solution = {}
+                for component, part in zip(components, parts):
+                    solution.update(zip(component.variables, part))
+                yield {var: solution[var] for var in template.variables}
+            return
+
+        sampler = _Sampler(
+            template, domains_copy, unique, budget=budget, propagated=True
+        )
+        while True:
+            solution = sampler.sample()
+            if solution is None:
+                break
+            yield dict(zip(template.variables, solution))
+        return
+
+    if engine == "backtrack":
+
+        def backtracker(
+            seen: _SolutionSet | None,
+            exhausted: set[frozenset[tuple[int, int]]] | None = None,
+        ) -> Callable:
+            return functools.partial(
+                _search,
+                # Components can't all be 0 at once, but one of them can.
+                exclude_zero=not components,
+                vectorize=vectorize,
+                seen=seen,
+                order=order,
+                consistency=consistency,
+                backjump=backjump,
+                nogoods=_NogoodStore(max_nogoods) if max_nogoods > 0 else None,
+                budget=budget,
+                propagated=True,
+                exhausted=exhausted,
+            )
+
+        if components:
+            solve = functools.partial(
+                _search_components,
+                components=components,
+                solvers=[backtracker(None) for _ in components],
+            )
+        else:
+            seen = _SolutionSet(template, domains_copy) if unique else None
+            # Searches that restart after each solution skip the subtrees
+            # whose solutions have all been produced.
+            solve = backtracker(seen, set() if unique and not resume else None)
+    elif engine == "join":
+        plan = _join_plan(template)
+        if plan is None:
+            raise ValueError(
+                "The join engine needs an Equal between a sum of independent "
+                "subexpressions and a value that shares none of their variables"
+            )
+        solve = functools.partial(_join, plan=plan, budget=budget, propagated=True)
+        resume = True
+    else:
+        raise ValueError(f"Unknown engine: {engine}")
+
+    while True:
+        for var, domain in domains_copy.items():
+            domains_copy[var] = _shuffle(domain)
+
+        if resume:
+            found = False
+            for solution in solve(template, domains_copy):
+                found = True
+                yield solution
+            # A single resumed pass produces every solution exactly once.
+            if not found or unique:
+                break
+            continue
+
+        solution = next(solve(template, domains_copy), None)
+        if solution is None:
+            break
+        yield solution
+
+
+def _search_components(
+    template: CompiledTemplate,
+    domains: dict[Variable, list[int]],
+    components: list[CompiledTemplate],
+    solvers: list[Callable],
+) -> Generator[dict[Variable, int], None, None]:
+    """
+    Yield every combination of the solutions of independent components.
+
+    The components are combined like the digits of an odometer, with the
+    last component changing fastest. Each component after the first is
+    searched only once: its solutions are remembered during the first pass
+    and replayed after that, so the work grows with the sum of the
+    components' search spaces rather than their product.
+
+    Args:
+        template: Compiled variables and constraints to solve.
+        domains: Dictionary mapping Variable objects to their possible values.
+        components: Templates of groups of variables that share no constraint.
+        solvers: Function to search each component with.
+
+    Yields:
+        Dictionary mapping variables to values that satisfies all constraints.
+    """
+    remembered: list[list[dict[Variable, int]] | None] = [None] * len(components)
+
+    def solutions(k: int) -> Generator[dict[Variable, int], None, None]:
+        if remembered[k] is not None:
+            yield from remembered[k]
+            return
+        found = []
+        for solution in solvers[k](components[k], domains):
+            if k:
+                found.append(solution)
+            yield solution
+        if k:
+            remembered[k] = found
+
+    passes = [solutions(k) for k in range(len(components))]
+    current = []
+    for solutions_k in passes:
+        solution = next(solutions_k, None)
+        if solution is None:
+            return
+        current.append(solution)
+
+    while True:
+        combined = {}
+        for solution in current:
+            combined.update(solution)
+        # The solver never returns the assignment where every variable is 0.
+        if any(combined.values()):
+            yield {var: combined[var] for var in template.variables}
+
+        k = len(components) - 1
+        while True:
+            solution = next(passes[k], None)
+            if solution is not None:
+                current[k] = solution
+                break
+            if not k:
+                return
+            passes[k] = solutions(k)
+            current[k] = next(passes[k])
+            k -= 1
+
+
+def find_bindings(
+    variables: list[Variable],
+    domains: dict[Variable, list[int]],
+    constraints: list[Constraint],
+    n_bindings: int = 1,
+    resume: bool = False,
+    engine: str = "backtrack",
+    vectorize: bool = False,
+    uniform: bool = False,
+    unique: bool = False,
+    order: str = "static",
+    check_order: Sequence[int] | None = None,
+    consistency: str = "bounds",
+    backjump: bool = False,
+    max_nogoods: int = 0,
+    timeout: float | None = None,
+    max_nodes: int | None = None,
+    break_symmetry: bool = False,
+    workers: int = 1,
+) -> list[dict[Variable, int]]:
+    """
+    Find multiple solutions to a constraint satisfaction problem.
+
+    With workers above 1 the solutions are generated by that many worker
+    processes, each seeded from the random module, and merged as batches
+    finish. Without unique=True every batch searches the whole problem, so
+    uniform=True still draws every solution with equal probability. With
+    unique=True the values of the variable with the most values are split
+    between the batches instead, so that no two batches can produce the
+    same solution, and each part of the values is asked for an even share
+    of the solutions. With uniform=True as well the parts' solutions are
+    counted first and each part is asked for as many solutions as a
+    uniform draw from the whole problem would take from it. Symmetries are
+    broken before the values are split.
+    The variables, domains and constraints are pickled to
+    reach the workers, so custom constraints must be defined at the top
+    level of a module. timeout applies to the whole call and max_nodes to
+    each batch.
+
+    Args:
+        variables: List of Variable objects to assign.
+        domains: Dictionary mapping Variable objects to their possible values.
+        constraints: List of constraints that must be satisfied.
+        n_bindings: Number of solutions to find (default=1).
+        resume: Continue the previous search instead of restarting it for
+            every solution (default=False).
+        engine: "backtrack" or "join" (default="backtrack").
+        vectorize: Check the last variable's values with NumPy (default=False).
+        uniform: Draw every solution with equal probability (default=False).
+        unique: Never return the same solution twice (default=False).
+        order: "static", "mrv", "degree" or "domwdeg" (default="static").
+        check_order: Positions in `constraints` in the order to check them
+            (default=None, declaration order).
+        consistency: "bounds", "arc" or "mac" (default="bounds").
+        backjump: Jump back to the cause of a dead end (default=False).
+        max_nogoods: Number of nogoods to remember while backjumping
+            (default=0).
+        timeout: Seconds the search may take (default=None, no limit).
+        max_nodes: Search tree nodes the search may visit (default=None,
+            no limit).
+        break_symmetry: Return one solution of each group of solutions that
+            swapping interchangeable variables links (default=False).
+        workers: Number of processes to generate solutions in (default=1).
+
+    Returns:
+        List of dictionaries mapping variables to values that satisfy all constraints.
+
+    Raises:
+        SearchTimeout: If the search runs out of time or nodes. Its bindings
+            attribute holds the solutions found until then.
+    """
+    options = dict(
+        resume=resume,
+        engine=engine,
+        vectorize=vectorize,
+        uniform=uniform,
+        unique=unique,
+        order=order,
+        check_order=check_order,
+        consistency=consistency,
+        backjump=backjump,
+        max_nogoods=max_nogoods,
+        timeout=timeout,
+        max_nodes=max_nodes,
+        break_symmetry=break_symmetry,
+    )
+    if workers > 1:
+        gen = _parallel_bindings(
+            variables, domains, constraints, n_bindings, workers, options
+        )
+    else:
+        gen = gen_bindings(variables, domains, constraints, **options)
+    all_bindings = []
+    for _ in range(n_bindings):
+        try:
+            all_bindings.append(next(gen))
+        except StopIteration:
+            break
+        except SearchTimeout as e:
+            e.bindings = all_bindings
+            raise
+    return all_bindings
+
+
+# Most solutions a worker generates in one batch without unique=True.
+_WORKER_BATCH_SIZE = 1000
+
+# Number of parts per worker that unique=True splits the problem into.
+_PARTS_PER_WORKER = 4
+
+
+def _worker_bindings(
+    problem: tuple[list[Variable], dict[Variable, Sequence[int]], list[Constraint]],
+    n_bindings: int,
+    seed: int,
+    options: dict,
+) -> tuple[list[tuple[int, ...]], bool]:
+    """
+    Generate a batch of solutions in a worker process.
+
+    Args:
+        problem: Variables, domains and constraints, pickled together so the
+            constraints keep referring to the same variables.
+        n_bindings: Number of solutions to find.
+        seed: Seed for the worker's random number generator.
+        options: Keyword arguments for find_bindings().
+
+    Returns:
+        The solutions' values in the order of the variables, and whether
+        the batch ran out of time or nodes.
+    """
+    variables, domains, constraints = problem
+    random.seed(seed)
+    try:
+        bindings = find_bindings(variables, domains, constraints, n_bindings, **options)
+        timed_out = False
+    except SearchTimeout as e:
+        bindings, timed_out = e.bindings, True
+    return [tuple(binding[v] for v in variables) for binding in bindings], timed_out
+
+
+def _worker_count(
+    problem: tuple[list[Variable], dict[Variable, Sequence[int]], list[Constraint]],
+) -> int:
+    """
+    Count the solutions of one part of a problem in a worker process.
+
+    Args:
+        problem: Variables, domains and constraints, pickled together so the
+            constraints keep referring to the same variables.
+
+    Returns:
+        Number of solutions of the part.
+    """
+    variables, domains, constraints = problem
+    return n_solutions(variables, domains, constraints)
+
+
+def _parallel_bindings(
+    variables: list[Variable],
+    domains: dict[Variable, Sequence[int]],
+    constraints: list[Constraint],
+    n_bindings: int,
+    workers: int,
+    options: dict,
+) -> Generator[dict[Variable, int], None, None]:
+    """
+    Generate solutions in a pool of worker processes, as described by
+    find_bindings(), yielding each batch's solutions as the batch finishes.
+
+    Raises:
+        SearchTimeout: If a batch runs out of time or nodes.
+    """
+    timeout = options.pop("timeout")
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    # A worker that sees only some of a variable's values can't tell that
+    # the variable is interchangeable with another, so the symmetries are
+    # broken here and the workers get the constraints that break them.
+    if options["break_symmetry"]:
+        template = compile_template(variables, constraints)
+        if options["check_order"] is not None:
+            template.order_checks(options["check_order"])
+        template = template.break_symmetries(domains)
+        constraints = template.constraints
+        options = {
+            **options,
+            "check_order": template.check_order,
+            "break_symmetry": False,
+        }
+
+    # Split the most varied variable's values into parts whose solutions
+    # can't overlap, or else let every batch search the whole problem.
+    parts: list[dict[Variable, Sequence[int]]] | None = None
+    if options["unique"] and variables:
+        split = max(variables, key=lambda var: len(domains[var]))
+        values = domains[split]
+        if not isinstance(values, range):
+            values = list(dict.fromkeys(values))
+        n_parts = min(len(values), workers * _PARTS_PER_WORKER) or 1
+        parts = [{**domains, split: values[k::n_parts]} for k in range(n_parts)]
+    # Parts still to be asked in this round, parts that gave every solution
+    # asked of them and may hold more, and the solutions found in each part.
+    waiting = list(range(len(parts))) if parts is not None else []
+    random.shuffle(waiting)
+    refill: list[int] = []
+    found: list[set[tuple[int, ...]]] = [set() for _ in parts or []]
+    # Number of solutions each part is asked for when they are drawn uniformly.
+    quota: list[int] | None = None
+
+    needed = n_bindings
+    # Maps each batch to its part, or None, the new solutions it was meant
+    # to find and the number of solutions it was asked for.
+    pending: dict[Future, tuple[int | None, int, int]] = {}
+    pool = ProcessPoolExecutor(workers)
+    try:
+        if parts is not None and options["uniform"]:
+            # Drawing distinct solutions uniformly from the whole problem
+            # picks a uniform set of positions among all its solutions, so
+            # each part is asked for the positions that fall in its own
+            # solutions, and draws those uniformly in turn.
+            problems = [(variables, part, constraints) for part in parts]
+            counting = [pool.submit(_worker_count, p) for p in problems]
+            remaining = None if deadline is None else deadline - time.monotonic()
+            _, not_done = wait(counting, timeout=remaining)
+            if not_done:
+                raise SearchTimeout("Search ran out of time or nodes")
+            ends = list(itertools.accumulate(f.result() for f in counting))
+            total = ends[-1]
+            quota = [0] * len(parts)
+            for position in random.sample(range(total), min(n_bindings, total)):
+                quota[bisect.bisect_right(ends, position)] += 1
+            waiting = [index for index in waiting if quota[index]]
+            needed = sum(quota)
+        while needed > 0:
+            if parts is not None and not waiting and not pending:
+                waiting, refill = refill, []
+            while len(pending) < workers and (parts is None or waiting):
+                if parts is None:
+                    index = None
+                    part = domains
+                    share = n = min(-(-needed // workers), _WORKER_BATCH_SIZE)
+                elif quota is not None:
+                    index = waiting.pop()
+                    part = parts[index]
+                    share = n = quota[index]
+                else:
+                    # Each part is asked for an even share of the solutions
+                    # that no batch is looking for yet, so that no one part
+                    # provides them all. A part asked again finds the
+                    # solutions it found before among the new ones.
+                    unassigned = needed - sum(s for _, s, _ in pending.values())
+                    if unassigned <= 0:
+                        break
+                    index = waiting.pop()
+                    part = parts[index]
+                    share = -(-unassigned // (len(waiting) + 1))
+                    n = len(found[index]) + share
+                if deadline is not None:
+                    options["timeout"] = max(0.0, deadline - time.monotonic())
+                problem = (variables, part, constraints)
+                seed = random.getrandbits(64)
+                future = pool.submit(_worker_bindings, problem, n, seed, options)
+                pending[future] = (index, share, n)
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, _, asked = pending.pop(future)
+                rows, timed_out = future.result()
+                if index is not None:
+                    if len(rows) == asked and quota is None:
+                        refill.append(index)
+                    rows = [row for row in rows if row not in found[index]]
+                    found[index].update(rows)
+                for row in rows:
+                    needed -= 1
+                    yield dict(zip(variables, row))
+                if timed_out:
+                    raise SearchTimeout("Search ran out of time or nodes")
+                # A batch that searches the whole problem comes up short
+                # only when there are no solutions.
+                if index is None and len(rows) < asked:
+                    needed = 0
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+# Seconds between checks that the processes of a portfolio are still alive.
+_PORTFOLIO_POLL_INTERVAL = 0.1
+
+# Search configurations that solve_portfolio() races by default.
+_PORTFOLIO = (
+    {},
+    {"order": "mrv"},
+    {"order": "domwdeg"},
+    {"order": "domwdeg", "consistency": "mac"},
+    {"backjump": True, "max_nogoods": 1000},
+    {"uniform": True},
+)
+
+
+def _portfolio_worker(
+    problem: tuple[list[Variable], dict[Variable, Sequence[int]], list[Constraint]],
+    index: int,
+    config: dict,
+    results: multiprocessing.Queue,
+) -> None:
+    """
+    Run one configuration of a portfolio and report its first solution.
+
+    Puts (index, values, error) on `results`, where values are the
+    solution's values in the order of the variables, or None if there is no
+    solution, and error is the exception the search raised, if any.
+    """
+    variables, domains, constraints = problem
+    options = dict(config)
+    random.seed(options.pop("seed"))
+    try:
+        bindings = find_bindings(variables, domains, constraints, 1, **options)
+    except Exception as e:
+        results.put((index, None, e))
+        return
+    values = tuple(bindings[0][v] for v in variables) if bindings else None
+    results.put((index, values, None))
+
+
+def solve_portfolio(
+    variables: list[Variable],
+    domains: dict[Variable, Sequence[int]],
+    constraints: list[Constraint],
+    configs: Sequence[dict] | None = None,
+    timeout: float | None = None,
+) -> tuple[dict[Variable, int] | None, dict]:
+    """
+    Race several randomised searches for a solution in separate processes
+    and return the first one found.
+
+    How long a search takes can vary by orders of magnitude with the order
+    its domains are shuffled into, so racing a few differently seeded and
+    configured searches cuts the slow tail. As soon as one search finishes
+    the other processes are terminated.
+
+    Each configuration holds keyword arguments for find_bindings(), such as
+    {"order": "mrv"}, and is given its own seed from the random module.
+    The winning configuration is returned with its "seed", so the winning
+    search can be repeated by calling random.seed() with the seed and
+    passing the other entries to find_bindings(). The problem is pickled to
+    reach the processes, so custom constraints must be defined at the top
+    level of a module.
+
+    Args:
+        variables: List of Variable objects to assign.
+        domains: Dictionary mapping Variable objects to their possible values.
+        constraints: List of constraints that must be satisfied.
+        configs: find_bindings() options for each search (default=None,
+            a built-in mix of variable orders, consistency levels,
+            backjumping and uniform sampling).
+        timeout: Seconds to wait for a search to finish (default=None,
+            no limit).
+
+    Returns:
+        The first solution found, or None if a search proved there is none,
+        and the configuration of the search that finished first.
+
+    Raises:
+        ValueError: If configs is empty.
+        SearchTimeout: If no search finishes in time.
+        RuntimeError: If every process exits without a result.
+    """
+    configs = _PORTFOLIO if configs is None else configs
+    if not configs:
+        raise ValueError("A portfolio needs at least one configuration")
+    configs = [{**config, "seed": random.getrandbits(64)} for config in configs]
+    problem = (variables, domains, constraints)
+    results: multiprocessing.Queue = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=_portfolio_worker,
+            args=(problem, index, config, results),
+            daemon=True,
+        )
+        for index, config in enumerate(configs)
+    ]
+    deadline = None if timeout is None else time.monotonic() + timeout
+    try:
+        for process in processes:
+            process.start()
+        errors = []
+        reported = 0
+        while reported < len(processes):
+            wait_for = _PORTFOLIO_POLL_INTERVAL
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise SearchTimeout("No search in the portfolio finished in time")
+                wait_for = min(wait_for, remaining)
+            try:
+                index, values, error = results.get(timeout=wait_for)
+            except queue.Empty:
+                # A process that exits puts its result first, so once every
+                # process has exited without one, no result is coming.
+                if not any(process.is_alive() for process in processes):
+                    break
+                continue
+            reported += 1
+            # A search that fails is left to the others, unless they all do.
+            if error is not None:
+                errors.append(error)
+                continue
+            solution = None if values is None else dict(zip(variables, values))
+            return solution, configs[index]
+        if errors:
+            raise errors[0]
+        codes = [process.exitcode for process in processes]
+        raise RuntimeError(f"Every search in the portfolio exited early: {codes}")
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+
+
+# Number of templates whose latency estimates are kept.
+_LATENCY_CACHE_SIZE = 1000
+
+# Weight of the newest measurement in a latency estimate.
+_LATENCY_SMOOTHING = 0.2
+
+
+class _Latency:
+    """
+    Moving average of the seconds a template takes to produce a solution,
+    weighted towards recent solutions.
+
+    Args:
+        variables: List of Variable objects of the template.
+        constraints: List of constraints of the template.
+    """
+
+    def __init__(self, variables: list[Variable], constraints: list[Constraint]):
+        # Holding on to the objects stops the ids that key the estimate from
+        # being reused by other objects.
+        self.variables = list(variables)
+        self.constraints = list(constraints)
+        self.estimate: float | None = None
+
+    def record(self, seconds: float) -> None:
+        if self.estimate is None:
+            self.estimate = seconds
+        else:
+            self.estimate += _LATENCY_SMOOTHING * (seconds - self.estimate)
+
+
+# Latency estimates, least recently used first.
+_latencies: dict[tuple[tuple[int, ...], tuple[int, ...]], _Latency] = {}
+
+
+def _latency_key(
+    variables: list[Variable], constraints: list[Constraint]
+) -> tuple[tuple[int, ...], tuple[int, ...]]:
+    return tuple(map(id, variables)), tuple(map(id, constraints))
+
+
+def _latency(variables: list[Variable], constraints: list[Constraint]) -> _Latency:
+    """
+    Get the latency estimate of a template, creating it if needed.
+    """
+    key = _latency_key(variables, constraints)
+    latency = _latencies.pop(key, None)
+    if latency is None:
+        latency = _Latency(variables, constraints)
+    _latencies[key] = latency
+    if len(_latencies) > _LATENCY_CACHE_SIZE:
+        del _latencies[next(iter(_latencies))]
+    return latency
+
+
+def latency_estimate(
+    variables: list[Variable], constraints: list[Constraint]
+) -> float | None:
+    """
+    Estimate how long find_bindings() and gen_bindings() take to produce a
+    solution of a template, for example to decide whether to serve a cached
+    solution instead.
+
+    The estimate is a moving average over the solutions produced so far,
+    weighted towards recent ones. Searches that ran out of time count with
+    the time they took. Templates are identified by their variable and
+    constraint objects, so reuse the same objects between calls.
+
+    Args:
+        variables: List of Variable objects of the template.
+        constraints: List of constraints of the template.
+
+    Returns:
+        Seconds per solution, or None if the template hasn't been solved.
+    """
+    latency = _latencies.get(_latency_key(variables, constraints))
+    return None if latency is None else latency.estimate
+
+
+def n_solutions(
+    variables: list[Variable],
+    domains: dict[Variable, list[int]],
+    constraints: list[Constraint],
+    break_symmetry: bool = False,
+) -> int:
+    """
+    Count the number of solutions to a constraint satisfaction problem.
+
+    With break_symmetry=True solutions that swapping interchangeable
+    variables turns into each other, such as 3*4 and 4*3, count once, as
+    described by CompiledTemplate.break_symmetries().
+
+    Args:
+        variables: List of Variable objects to assign.
+        domains: Dictionary mapping Variable objects to their possible values.
+        constraints: List of constraints that must be satisfied.
+        break_symmetry: Count interchangeable solutions once (default=False).
+
+    Returns:
+        Number of unique solutions found.
+    """
+    template = compile_template(variables, constraints)
+    if break_symmetry:
+        template = template.break_symmetries(domains)
+    return _count(template, domains)
+
+
+def find_conflict(
+    variables: list[Variable],
+    domains: dict[Variable, list[int]],
+    constraints: list[Constraint],
+) -> Constraint | None:
+    """
+    Check a constraint satisfaction problem for a constraint that can't be
+    satisfied, without searching.
+
+    Narrowing stops at a fixpoint, or after _FIXPOINT_BUDGET constraint
+    revisions for domains of a million or so values, where searching a
+    template with no solutions would try every combination of values. It
+    can miss conflicts that only a search would find, so None doesn't
+    guarantee a solution exists.
+
+    Args:
+        variables: List of Variable objects to assign.
+        domains: Dictionary mapping Variable objects to their possible values.
+        constraints: List of constraints that must be satisfied.
+
+    Returns:
+        The constraint that can't be satisfied, or None if none was found.
+    """
+    return compile_template(variables, constraints).find_conflict(domains)
+
+
+def _count(template: CompiledTemplate, domains: dict[Variable, list[int]]) -> int:
+    """
+    Count every solution of a compiled template without building them.
+
+    Groups of variables that share no constraint are counted separately and
+    the counts multiplied, and unconstrained variables cost nothing to count.
+
+    Args:
+        template: Compiled variables and constraints to solve.
+        domains: Dictionary mapping Variable objects to their possible values.
+
+    Returns:
+        Number of solutions.
+    """
+    n = len(template.variables)
+    if not n or not all(check([]) for needed, check in template.checks if not needed):
+        return 0
+
+    total = 1
+    for component in template.components():
+        if not component.checks:
+            for var in component.variables:
+                total *= len(domains[var])
+        else:
+            total *= _Search(component, domains, exclude_zero=False).count()
+        if not total:
+            return 0
+
+    # The solver never returns the assignment where every variable is 0.
+    if all(0 in domains[v] for v in template.variables) and all(
+        check([0] * n) for _, check in template.checks
+    ):
+        total -= 1
+    return total
+
+
+# Prefixes per shard, so that a checkpoint is never far behind.
+_PREFIXES_PER_SHARD = 64
+
+
+@dataclass
+class Shard:
+    """
+    A slice of a problem's search space that can be searched on its own,
+    and a cursor recording how far the search has got.
+
+    The search space is split by the values of the first `depth` variables
+    in the order given, the order the backtracking solver assigns them in.
+    Each combination of their values is a prefix, numbered like the digits
+    of a number with the last of the variables changing fastest. The last
+    variable's values can instead be cut into `parts` slices of consecutive
+    values, each slice a digit, so that a large domain doesn't make far more
+    prefixes than needed. A shard holds the prefixes numbered from `start`
+    up to but not including `stop`.
+
+    The fields are plain integers, so a shard can be saved with
+    dataclasses.asdict() and json, and restored with Shard(**fields).
+
+    Args:
+        depth: Number of leading variables whose values form a prefix.
+        start: Number of the shard's first prefix.
+        stop: Number one past the shard's last prefix.
+        position: Number of the next prefix to search.
+        skip: Solutions of prefix `position` already produced.
+        found: Solutions produced, or counted, so far.
+        parts: Number of slices the last variable's values are cut into, or
+            0 for a digit per value.
+    """
+
+    depth: int
+    start: int
+    stop: int
+    position: int
+    skip: int = 0
+    found: int = 0
+    parts: int = 0
+
+    @property
+    def done(self) -> bool:
+        """
+        Whether every prefix of the shard has been searched.
+        """
+        return self.position >= self.stop
+
+
+def shard_search(
+    variables: list[Variable],
+    domains: dict[Variable, Sequence[int]],
+    n_shards: int,
+) -> list[Shard]:
+    """
+    Split a problem's search space into shards for separate processes or
+    machines to enumerate with search_shard() or count with count_shard().
+
+    Enough leading variables are used that every shard gets several
+    prefixes, so a checkpoint taken after each prefix is never far behind.
+
+    Args:
+        variables: List of Variable objects to assign, in the order given
+            to the solver.
+        domains: Dictionary mapping Variable objects to their possible values.
+        n_shards: Number of shards to split the search space into.
+
+    Returns:
+        Up to n_shards shards that together cover the search space once.
+    """
+    target = n_shards * _PREFIXES_PER_SHARD
+    depth = 0
+    n_prefixes = 1
+    parts = 0
+    while depth < len(variables) and n_prefixes < target:
+        size = len(_shard_domain(domains[variables[depth]]))
+        depth += 1
+        if n_prefixes * size > target:
+            # Every prefix costs a search of its own, so slice the last
+            # variable's values rather than overshoot the target.
+            parts = -(-target // n_prefixes)
+            n_prefixes *= parts
+        else:
+            n_prefixes *= size
+    n_shards = max(1, min(n_shards, n_prefixes))
+    bounds = [n_prefixes * k // n_shards for k in range(n_shards + 1)]
+    return [
+        Shard(depth, start, stop, start, parts=parts)
+        for start, stop in zip(bounds, bounds[1:])
+    ]
+
+
+def search_shard(
+    variables: list[Variable],
+    domains: dict[Variable, Sequence[int]],
+    constraints: list[Constraint],
+    shard: Shard,
+) -> Generator[dict[Variable, int], None, None]:
+    """
+    Yield every solution in a shard, in the same order each time, carrying
+    on from the shard's cursor.
+
+    The shard is updated after every solution, so saving it at any point
+    and passing the saved copy to a later call resumes the enumeration
+    without repeating or missing a solution. Only the prefix the search
+    was stopped in is searched again.
+
+    Args:
+        variables: List of Variable objects to assign, as given to
+            shard_search().
+        domains: Dictionary mapping Variable objects to their possible values.
+        constraints: List of constraints that must be satisfied.
+        shard: Shard to search, updated as the search goes.
+
+    Yields:
+        Dictionary mapping variables to values that satisfies all constraints.
+    """
+    template = compile_template(variables, constraints)
+    while not shard.done:
+        prefix_domains = _prefix_domains(variables, domains, shard)
+        skip = shard.skip
+        for solution in _search(template, prefix_domains):
+            if skip:
+                skip -= 1
+                continue
+            shard.skip += 1
+            shard.found += 1
+            yield solution
+        shard.position += 1
+        shard.skip = 0
+
+
+def count_shard(
+    variables: list[Variable],
+    domains: dict[Variable, Sequence[int]],
+    constraints: list[Constraint],
+    shard: Shard,
+) -> int:
+    """
+    Count the solutions in a shard, carrying on from the shard's cursor.
+
+    The shard's `found` is updated after each prefix, so a count that is
+    stopped part way can be resumed from a saved copy of the shard. Adding
+    up the counts of every shard from shard_search() gives n_solutions(),
+    once duplicate values are removed from the domains.
+
+    Args:
+        variables: List of Variable objects to assign, as given to
+            shard_search().
+        domains: Dictionary mapping Variable objects to their possible values.
+        constraints: List of constraints that must be satisfied.
+        shard: Shard to count, updated as the count goes.
+
+    Returns:
+        Number of solutions in the shard.
+    """
+    template = compile_template(variables, constraints)
+    while not shard.done:
+        shard.found += _count(template, _prefix_domains(variables, domains, shard))
+        shard.position += 1
+    return shard.found
+
+
+def _shard_domain(domain: Sequence[int]) -> Sequence[int]:
+    """
+    Return a domain's values without duplicates, in a fixed order.
+    """
+    if isinstance(domain, range):
+        return domain
+    return list(dict.fromkeys(domain))
+
+
+def _prefix_domains(
+    variables: list[Variable], domains: dict[Variable, Sequence[int]], shard: Shard
+) -> dict[Variable, Sequence[int]]:
+    """
+    Return the domains of the prefix at a shard's position: the leading
+    variables' domains are narrowed to the prefix's values.
+    """
+    prefix_domains = {var: _shard_domain(domains[var]) for var in variables}
+    number = shard.position
+    for k in reversed(range(shard.depth)):
+        var = variables[k]
+        domain = prefix_domains[var]
+        if k == shard.depth - 1 and shard.parts:
+            number, digit = divmod(number, shard.parts)
+            size = len(domain)
+            start = size * digit // shard.parts
+            prefix_domains[var] = domain[start : size * (digit + 1) // shard.parts]
+            continue
+        number, digit = divmod(number, len(domain))
+        prefix_domains[var] = [domain[digit]]
+    return prefix_domains
+
+
+def expression_string(
+    expression: Value,
+    values: dict[Variable, int],
+    hold_out: Variable | None = None,
+    underline: Variable | None = None,
+) -> str:
+    """
+    Convert a value expression to a string representation with variable values.
+
+    Args:
+        expression: Value expression to convert to string.
+        values: Dictionary mapping Variable objects to their values.
+        hold_out: Optional variable to replace with underscores.
+        underline: Optional variable to underline in output.
+
+    Returns:
+        String representation of the expression with variables replaced by their values.
+    """
+
+    def _generate(expr: Value, parent_op: str = None) -> str:
+        if isinstance(expr, Variable):
+            if expr == hold_out:
+                return "_" * len(str(values[expr]))
+            elif expr == underline:
+                return f"<u>{str(values[expr])}</u>"
+            else:
+                return str(values[expr])
+        elif isinstance(expr, Lit):
+            return str(expr.val)
+        elif isinstance(expr, Add):
+            left = _generate(expr.operand1, "+")
+            right = _generate(expr.operand2, "+")
+            result = f"{left} + {right}"
+            if parent_op in ("*", "-"):
+                return f"({result})"
+            return result
+        elif isinstance(expr, Subtract):
+            left = _generate(expr.operand1, "-")
+            right = _generate(expr.operand2, "-")
+            result = f"{left} - {right}"
+            if parent_op in ("*", "-"):
+                return f"({result})"
+            return result
+        elif isinstance(expr, Multiply):
+            left = _generate(expr.operand1, "*")
+            right = _generate(expr.operand2, "*")
+            return f"{left} x {right}"
+        else:
+            raise ValueError(f"Unsupported expression type: {type(expr)}")
+
+    return _generate(expression)
+
+
+def uniform_domains(
+    variables: list[Variable], domain: Sequence[int]
+) -> dict[Variable, Sequence[int]]:
+    """
+    Give every variable the same domain.
+
+    A range is shared by all of the variables rather than listed, so even
+    range(10**6) costs nothing to set up: the solvers narrow, shuffle and
+    test membership of ranges without listing their values. Ranges can't be
+    changed in place, so a variable that needs other values is given a new
+    domain rather than having the shared one edited. Any other sequence is
+    copied into a separate list for each variable.
+
+    Args:
+        variables: List of Variable objects to give the domain to.
+        domain: Possible values of every variable.
+
+    Returns:
+        Dictionary mapping each variable to its possible values: the same
+        range object for every variable if `domain` is a range, or else a
+        new list for each variable.
+    """
+    if isinstance(domain, range):
+        return {v: domain for v in variables}
     return {v: list(domain) for v in variables}
@@ -1,13 +1,19 @@
+import pytest
+
 from sumchef import (
     Add,
+    AdditionCrosses10Boundary,
+    Constraint,
     Equal,
     IsDivisibleBy,
     IsGreaterThan,
     IsLessThan,
     Lit,
     Multiply,
+    NOf,
     Subtract,
     Variable,
+    compile_template,
     filter_variables,
     find_bindings,
     uniform_domains,
@@ -156,6 +162,29 @@ def test_uniform_domains():
     assert domains[b] == [1, 2, 3]
 
 
+def test_range_domains():
+    x = Variable("x")
+    y = Variable("y")
+
+    # Ranges are shared rather than listed
+    domains = uniform_domains([x, y], range(10**9))
+    assert domains[x] is domains[y]
+
+    # and narrowing cuts them into smaller ranges
+    assert Multiply(x, Lit(1000)).narrow(5000, 20000, domains)
+    assert domains[x] == range(5, 21)
+    assert x.narrow_residues(7, {3}, domains)
+    assert domains[x] == range(10, 21, 7)
+    assert x.residues(7, domains) == {3}
+    # Narrowing replaces x's domain, leaving the shared range alone
+    assert domains[y] == range(10**9)
+
+    # Other sequences are copied for each variable
+    lists = uniform_domains([x, y], [1, 2])
+    lists[x].append(3)
+    assert lists[y] == [1, 2]
+
+
 def test_find_bindings_simple():
     x = Variable("x")
     y = Variable("y")
@@ -175,3 +204,179 @@ def test_find_bindings_simple():
     # All solutions should satisfy the constraint
     for binding in bindings:
         assert binding[x] + binding[y] == 4
+
+
+def test_compiled_value():
+    a = Variable("a")
+    b = Variable("b")
+    c = Variable("c")
+
+    # Expression: (a + b) * c - 4
+    expr = Subtract(Multiply(Add(a, b), c), Lit(4))
+    compiled = expr.compile({a: 0, b: 1, c: 2})
+
+    assert compiled([5, 7, 2]) == expr.evaluate({a: 5, b: 7, c: 2})
+
+
+def test_compiled_constraints():
+    x = Variable("x")
+    y = Variable("y")
+    slots = {x: 0, y: 1}
+
+    n_of = NOf([Equal(x, Lit(1)), IsLessThan(x, y), IsDivisibleBy(y, Lit(3))], 2)
+    compiled = n_of.compile(slots)
+
+    for x_val, y_val in [(1, 3), (1, 2), (2, 3), (4, 3)]:
+        bindings = {x: x_val, y: y_val}
+        assert compiled([x_val, y_val]) == n_of.is_satisfied(bindings)
+
+
+def test_compile_template_custom_constraint():
+    class IsEven(Constraint):
+        def __init__(self, value):
+            self.value = value
+
+        def is_satisfied(self, bindings):
+            return self.value.evaluate(bindings) % 2 == 0
+
+        def variables(self):
+            return filter_variables(self.value.variables())
+
+    x = Variable("x")
+    y = Variable("y")
+    z = Variable("z")
+
+    # Constraints on variables that are never assigned are left out
+    template = compile_template([x, y], [IsEven(Add(x, y)), Equal(x, z)])
+
+    assert len(template.checks) == 1
+    needed, check = template.checks[0]
+    assert needed == {0, 1}
+    assert check([1, 3])
+    assert not check([1, 2])
+
+
+def test_compile_template_components():
+    a, b, c, d = variables(["a", "b", "c", "d"])
+    first = IsLessThan(a, b)
+    second = IsLessThan(d, c)
+    template = compile_template([a, b, c, d], [first, second])
+
+    # The groups are compiled once, until the check order changes
+    components = template.components()
+    assert [component.variables for component in components] == [[a, b], [c, d]]
+    assert template.components()[0] is components[0]
+    template.order_checks([1, 0])
+    assert template.components()[0] is not components[0]
+
+
+def test_compile_template_shared_subexpressions():
+    a, b, c = variables(["a", "b", "c"])
+
+    # The two products are different objects with the same structure
+    template = compile_template(
+        [a, b, c],
+        [IsLessThan(Multiply(a, b), Lit(20)), Equal(Add(Multiply(a, b), a), c)],
+    )
+
+    assert len(template.shared) == 1
+    needed, compute = template.shared[0]
+    assert needed == {0, 1}
+
+    s = [3, 4, 15]
+    assert compute(s)
+    assert template.cache == [12]
+    assert template.fast_checks[0](s)
+    assert template.fast_checks[1](s)
+    assert not template.fast_checks[1]([3, 4, 16])
+
+
+def test_value_bounds():
+    x = Variable("x")
+    y = Variable("y")
+    domains = {x: [-2, 5, 3], y: [4, 1]}
+
+    assert Add(x, y).bounds(domains) == (-1, 9)
+    assert Subtract(x, y).bounds(domains) == (-6, 4)
+    assert Multiply(x, y).bounds(domains) == (-8, 20)
+    assert Lit(7).bounds(domains) == (7, 7)
+
+
+def test_multiply_narrow():
+    x = Variable("x")
+    y = Variable("y")
+    domains = {x: list(range(2, 100)), y: list(range(2, 100))}
+
+    # x * y < 20 and y >= 2 means x <= 9
+    assert Multiply(x, y).narrow(float("-inf"), 19, domains)
+    assert domains[x] == list(range(2, 10))
+    assert domains[y] == list(range(2, 10))
+
+    # x * y can't be 1 when both are at least 2
+    assert not Multiply(x, y).narrow(1, 1, domains)
+
+
+def test_equal_propagate():
+    x = Variable("x")
+    y = Variable("y")
+    z = Variable("z")
+    domains = {x: [5, 1, 9], y: [1, 2, 3], z: list(range(0, 20))}
+
+    assert Equal(Add(x, y), z).propagate(domains)
+    assert domains[z] == list(range(2, 13))
+
+    # Narrowing replaces domains rather than modifying them
+    domains[z] = [11, 12]
+    original = domains[x]
+    assert Equal(Add(x, y), z).propagate(domains)
+    assert domains[x] == [9]
+    assert original == [5, 1, 9]
+
+
+def test_value_residues():
+    x = Variable("x")
+    y = Variable("y")
+    domains = {x: [3, 13, 24], y: [5]}
+
+    assert x.residues(10, domains) == {3, 4}
+    assert Add(x, y).residues(10, domains) == {8, 9}
+    assert Multiply(x, Lit(2)).residues(10, domains) == {6, 8}
+
+    # x * 5 ends in 5 only for odd x
+    assert Multiply(x, y).narrow_residues(10, {5}, domains)
+    assert domains[x] == [3, 13]
+
+
+def test_carry_propagate():
+    x = Variable("x")
+    y = Variable("y")
+    domains = {x: [3, 13], y: list(range(1, 30))}
+
+    # Only a last digit of at least 7 carries past 3
+    assert AdditionCrosses10Boundary(x, y).propagate(domains)
+    assert domains[y] == [7, 8, 9, 17, 18, 19, 27, 28, 29]
+
+    domains[y] = [10, 20]
+    assert not AdditionCrosses10Boundary(x, y).propagate(domains)
+
+
+def test_divisible_propagate():
+    x = Variable("x")
+    y = Variable("y")
+    domains = {x: list(range(1, 30)), y: [0, 2, 3, 4, 5]}
+
+    assert IsDivisibleBy(Add(x, Lit(1)), Lit(7)).propagate(domains)
+    assert domains[x] == [6, 13, 20, 27]
+
+    domains[x] = [20]
+    assert IsDivisibleBy(x, y).propagate(domains)
+    assert domains[y] == [2, 4, 5]
+
+
+def test_array_bindings():
+    numpy = pytest.importorskip("numpy")
+    x = Variable("x")
+    y = Variable("y")
+    bindings = {x: numpy.array([1, 2, 3, 4]), y: 2}
+
+    assert list(Multiply(Add(x, y), Lit(2)).evaluate(bindings)) == [6, 8, 10, 12]
@@ -1,16 +1,46 @@
+import asyncio
+import collections
+import dataclasses
+import itertools
+import json
+import os
+import random
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import diceomatic
 from diceomatic import (
     Add,
     AdditionCrosses10Boundary,
+    Constraint,
     Equal,
+    IsDivisibleBy,
     IsLessThan,
     Lit,
     Multiply,
     NOf,
+    SearchTimeout,
+    Shard,
     Subtract,
     Variable,
+    agen_bindings,
+    compile_template,
+    count_shard,
     expression_string,
+    filter_variables,
     find_bindings,
+    find_conflict,
+    gen_bindings,
+    latency_estimate,
+    n_solutions,
+    search_shard,
+    shard_search,
+    solve_portfolio,
     uniform_domains,
+    variables,
 )
 
 
@@ -135,6 +165,28 @@ def test_n_of_constraint():
         assert satisfied_count == 2
 
 
+def test_n_of_truthy_sub_constraints():
+    """Test that NOf counts sub-constraints that return truthy non-bools the
+    same way whether it is checked directly or compiled"""
+    a = Variable("a")
+
+    class Remainder(Constraint):
+        def is_satisfied(self, bindings):
+            return bindings[a] % 3
+
+        def variables(self):
+            return [a]
+
+    constraint = NOf([Remainder(), IsLessThan(a, Lit(3))], 1)
+    domains = uniform_domains([a], range(1, 6))
+
+    checked = [v for v in range(1, 6) if constraint.is_satisfied({a: v})]
+    solved = sorted(
+        s[a] for s in find_bindings([a], domains, [constraint], 5, unique=True)
+    )
+    assert checked == solved == [4, 5]
+
+
 def test_carrying_constraints():
     """Test the carrying constraints"""
     a = Variable("a")
@@ -213,3 +265,842 @@ def test_complex_solving():
         x_val = binding[x]
 
         assert a_val * (x_val**2) + b_val * x_val + c_val == d_val
+
+
+def test_resumed_generation_continues_search():
+    """Test that resume=True walks through every solution before repeating"""
+    x = Variable("x")
+    y = Variable("y")
+
+    domains = uniform_domains([x, y], range(1, 4))
+    constraint = Equal(Add(x, y), Lit(4))
+
+    gen = gen_bindings([x, y], domains, [constraint], resume=True)
+    first_pass = [next(gen) for _ in range(3)]
+
+    # x + y = 4 has exactly three solutions over [1-3], and a resumed search
+    # must produce each of them once before it starts over
+    assert sorted((b[x], b[y]) for b in first_pass) == [(1, 3), (2, 2), (3, 1)]
+
+    # The stream keeps going once the solutions are used up
+    binding = next(gen)
+    assert binding[x] + binding[y] == 4
+
+
+def test_constraints_checked_once_per_node():
+    """Test that a constraint is only checked when its last variable is bound"""
+    x = Variable("x")
+    y = Variable("y")
+    calls = []
+
+    class IsOdd(Constraint):
+        def __init__(self, value):
+            self.value = value
+
+        def is_satisfied(self, bindings):
+            calls.append(bindings)
+            return self.value.evaluate(bindings) % 2 == 1
+
+        def variables(self):
+            return filter_variables(self.value.variables())
+
+    domains = {x: [1, 2, 3], y: [1, 2, 3]}
+    bindings = find_bindings([x, y], domains, [IsOdd(x)], n_bindings=6, resume=True)
+
+    # Each value of x is checked at most once; binding y never re-checks it
+    assert len(bindings) == 6
+    assert len(calls) <= 3
+    assert all(binding[x] % 2 == 1 for binding in bindings)
+
+
+def test_propagation_before_search():
+    """Test that bounds propagation narrows domains before searching"""
+    a, b, c = Variable("a"), Variable("b"), Variable("c")
+    domains = uniform_domains([a, b, c], range(2, 100))
+    constraints = [IsLessThan(Multiply(a, b), Lit(20)), Equal(Add(a, b), c)]
+
+    template = compile_template([a, b, c], constraints)
+    assert template.propagate(domains) is None
+
+    assert max(domains[a]) == 9
+    assert max(domains[b]) == 9
+    assert max(domains[c]) == 18
+
+
+def test_propagation_detects_infeasibility():
+    """Test that propagation reports the constraint that can't be satisfied"""
+    a, b = Variable("a"), Variable("b")
+    domains = uniform_domains([a, b], range(2, 100))
+    impossible = IsLessThan(Multiply(a, b), Lit(4))
+
+    template = compile_template([a, b], [impossible])
+    assert template.propagate(domains) is impossible
+    assert find_bindings([a, b], domains, [impossible]) == []
+
+
+def test_direct_solve_last_variable():
+    """Test that the last variable of an Equal is solved for directly"""
+    x = Variable("x")
+    y = Variable("y")
+
+    # Solving 100 - 3x = y for x needs y to be 1 more than a multiple of 3
+    domains = {y: list(range(0, 20)), x: list(range(-1000, 1000))}
+    constraint = Equal(Subtract(Lit(100), Multiply(Lit(3), x)), y)
+
+    template = compile_template([y, x], [constraint])
+    assert (0, 1) in template.solvers
+    assert (0, 0) in template.solvers
+
+    gen = gen_bindings([y, x], domains, [constraint], resume=True)
+    solutions = {(b[x], b[y]) for b in (next(gen) for _ in range(7))}
+    assert solutions == {(x_val, 100 - 3 * x_val) for x_val in range(27, 34)}
+
+
+def test_no_direct_solve_for_nonlinear_variable():
+    """Test that variables appearing non-linearly are left to the search"""
+    x = Variable("x")
+    y = Variable("y")
+
+    template = compile_template([x, y], [Equal(Multiply(x, x), y)])
+    assert (0, 0) not in template.solvers
+    assert (0, 1) in template.solvers
+
+
+def test_join_engine_finds_every_solution():
+    """Test that the hash-join engine produces exactly the solutions of A*B + C*D = E"""
+    a, b, c, d, e = variables(["a", "b", "c", "d", "e"])
+    domains = uniform_domains([a, b, c, d, e], range(1, 6))
+    constraints = [
+        Equal(Add(Multiply(a, b), Multiply(c, d)), e),
+        IsLessThan(Multiply(a, b), Multiply(c, d)),
+    ]
+
+    expected = {
+        (va, vb, vc, vd, va * vb + vc * vd)
+        for va, vb, vc, vd in itertools.product(range(1, 6), repeat=4)
+        if va * vb + vc * vd <= 5 and va * vb < vc * vd
+    }
+
+    gen = gen_bindings([a, b, c, d, e], domains, constraints, engine="join")
+    found = [
+        tuple(bnd[v] for v in (a, b, c, d, e))
+        for bnd in itertools.islice(gen, len(expected))
+    ]
+    assert sorted(found) == sorted(expected)
+
+
+def test_join_engine_rejects_unsuitable_constraints():
+    """Test that the join engine refuses templates without an independent sum"""
+    x, y = Variable("x"), Variable("y")
+    domains = uniform_domains([x, y], range(1, 6))
+
+    with pytest.raises(ValueError):
+        find_bindings([x, y], domains, [Equal(Add(x, y), x)], engine="join")
+
+
+def test_vectorized_last_variable():
+    """Test that NumPy filtering of the last variable finds the same solutions"""
+    pytest.importorskip("numpy")
+    x, y, z = variables(["x", "y", "z"])
+    domains = uniform_domains([x, y, z], range(1, 30))
+    constraints = [
+        Equal(Add(Multiply(x, x), Multiply(y, y)), Multiply(z, z)),
+        NOf([IsLessThan(x, y), AdditionCrosses10Boundary(x, z)], 1),
+    ]
+
+    expected = {
+        (vx, vy, vz)
+        for vx, vy, vz in itertools.product(range(1, 30), repeat=3)
+        if vx * vx + vy * vy == vz * vz and (vx < vy) + (vx % 10 + vz % 10 >= 10) == 1
+    }
+
+    gen = gen_bindings([x, z, y], domains, constraints, resume=True, vectorize=True)
+    found = {(b[x], b[y], b[z]) for b in itertools.islice(gen, len(expected))}
+    assert found == expected
+
+
+def test_n_solutions_counts_every_solution():
+    """Test that n_solutions counts the whole solution space"""
+    a, b, c, d, e = variables(["a", "b", "c", "d", "e"])
+    domains = uniform_domains([a, b, c, d, e], range(2, 20))
+    constraints = [
+        AdditionCrosses10Boundary(Multiply(a, b), Multiply(c, d)),
+        IsLessThan(Multiply(a, b), Lit(20)),
+        Equal(Add(Multiply(a, b), Multiply(c, d)), e),
+    ]
+
+    expected = sum(
+        1
+        for va, vb, vc, vd in itertools.product(range(2, 20), repeat=4)
+        if (va * vb) % 10 + (vc * vd) % 10 >= 10
+        and va * vb < 20
+        and 2 <= va * vb + vc * vd < 20
+    )
+    assert n_solutions([a, b, c, d, e], domains, constraints) == expected
+
+
+def test_n_solutions_independent_groups():
+    """Test counting variables that share no constraint"""
+    x, y, z, w = variables(["x", "y", "z", "w"])
+    domains = uniform_domains([x, y, z, w], range(-1, 2))
+
+    # x + y = 0 has 3 solutions, z < w has 3 and w is otherwise free, but
+    # the all-zero assignment is never a solution
+    constraints = [Equal(Add(x, y), Lit(0)), IsLessThan(z, w)]
+    assert n_solutions([x, y, z, w], domains, constraints) == 3 * 3
+
+    constraints = [Equal(Add(x, y), Lit(0))]
+    assert n_solutions([x, y, z, w], domains, constraints) == 3 * 3 * 3 - 1
+
+
+def test_uniform_sampling():
+    """Test that uniform=True draws every solution about equally often"""
+    x, y = variables(["x", "y"])
+    domains = {x: list(range(1, 4)), y: list(range(1, 10))}
+
+    # x = 1 has 2 solutions, x = 2 has 5 and x = 3 has 8
+    constraints = [IsLessThan(y, Multiply(x, Lit(3)))]
+
+    random.seed(0)
+    bindings = find_bindings([x, y], domains, constraints, 3000, uniform=True)
+    counts = collections.Counter((b[x], b[y]) for b in bindings)
+
+    assert len(counts) == 15
+    assert all(120 < count < 290 for count in counts.values())
+
+
+@pytest.mark.parametrize(
+    "options",
+    [{}, {"backjump": True}, {"resume": True}, {"uniform": True}, {"engine": "join"}],
+)
+def test_unique_generation_stops_when_exhausted(options):
+    """Test that unique=True never repeats a solution and then stops"""
+    a, b, c, d, e = variables(["a", "b", "c", "d", "e"])
+    vs = [a, b, c, d, e]
+    domains = uniform_domains(vs, range(1, 7))
+    constraints = [
+        Equal(Add(Multiply(a, b), Multiply(c, d)), e),
+        AdditionCrosses10Boundary(Multiply(a, b), Lit(8)),
+    ]
+
+    bindings = list(gen_bindings(vs, domains, constraints, unique=True, **options))
+    solutions = {tuple(binding[v] for v in vs) for binding in bindings}
+
+    assert len(bindings) == len(solutions)
+    assert len(solutions) == n_solutions(vs, domains, constraints)
+
+
+def test_unique_generation_skips_exhausted_subtrees():
+    """Test that restarting for every unique solution doesn't search the
+    subtrees whose solutions have all been produced again"""
+    a, b = variables(["a", "b"])
+    calls = []
+
+    class Anything(Constraint):
+        def is_satisfied(self, bindings):
+            calls.append(bindings)
+            return True
+
+        def variables(self):
+            return [a, b]
+
+    domains = uniform_domains([a, b], range(1, 40))
+    bindings = find_bindings([a, b], domains, [Anything()], 2000, unique=True)
+
+    # Searching every value of b again for each value of a that is done
+    # would take about 16 checks per solution
+    assert len(bindings) == 39 * 39
+    assert len(calls) < 8 * len(bindings)
+
+
+@pytest.mark.parametrize("order", ["static", "mrv", "degree", "domwdeg"])
+def test_variable_orders_find_every_solution(order):
+    """Test that every variable order produces the same solutions"""
+    a, b, c, d, e = variables(["a", "b", "c", "d", "e"])
+    vs = [e, a, b, c, d]
+    domains = uniform_domains(vs, range(1, 7))
+    domains[d] = [3]
+    constraints = [
+        Equal(Add(Multiply(a, b), Multiply(c, d)), e),
+        IsLessThan(a, b),
+    ]
+
+    bindings = list(
+        gen_bindings(vs, domains, constraints, resume=True, unique=True, order=order)
+    )
+
+    expected = set()
+    for values in itertools.product(range(1, 7), repeat=4):
+        binding = dict(zip([e, a, b, c], values))
+        binding[d] = 3
+        if all(constraint.is_satisfied(binding) for constraint in constraints):
+            expected.add(tuple(binding[v] for v in vs))
+    assert {tuple(binding[v] for v in vs) for binding in bindings} == expected
+
+
+def test_unknown_variable_order():
+    """Test that an unknown variable order is rejected"""
+    a, b = variables(["a", "b"])
+    domains = uniform_domains([a, b], range(1, 5))
+
+    with pytest.raises(ValueError):
+        find_bindings([a, b], domains, [Equal(a, b)], order="random")
+
+
+def test_check_order():
+    """Test that check_order decides which constraint is checked first"""
+    x = Variable("x")
+    calls = []
+
+    class Logged(Constraint):
+        def __init__(self, name, divisor):
+            self.name = name
+            self.divisor = divisor
+
+        def is_satisfied(self, bindings):
+            calls.append(self.name)
+            return bindings[x] % self.divisor == 0
+
+        def variables(self):
+            return [x]
+
+    constraints = [Logged("two", 2), Logged("three", 3)]
+    bindings = find_bindings(
+        [x], {x: [1]}, constraints, n_bindings=1, check_order=[1, 0]
+    )
+
+    # x=1 fails the first check to run, so the other one never runs
+    assert bindings == []
+    assert calls == ["three"]
+
+
+def test_learn_check_order():
+    """Test that selective constraints are learned to run first"""
+    x, y = variables(["x", "y"])
+    domains = uniform_domains([x, y], range(1, 100))
+    constraints = [IsLessThan(x, Lit(99)), Equal(Add(x, y), Lit(50))]
+    template = compile_template([x, y], constraints)
+
+    order = template.learn_check_order(domains)
+
+    assert order == [1, 0]
+    assert template.check_order == [1, 0]
+    assert len(find_bindings([x, y], domains, constraints, check_order=order)) == 1
+
+
+def test_arc_consistency():
+    """Test that arc consistency removes values without a partner"""
+    a, b, c = variables(["a", "b", "c"])
+    divisible = IsDivisibleBy(a, b)
+    template = compile_template([a, b, c], [divisible, IsLessThan(c, Lit(3))])
+    domains = {a: [6, 7, 9], b: [2, 5], c: [1, 2, 3, 4]}
+
+    assert template.arc_consistency(domains) is None
+    assert domains == {a: [6], b: [2], c: [1, 2]}
+
+    domains = {a: [7, 11, 13], b: [2, 3, 5], c: [1]}
+    assert template.arc_consistency(domains) is divisible
+
+
+@pytest.mark.parametrize("consistency", ["arc", "mac"])
+def test_arc_consistency_search(consistency):
+    """Test that searching with arc consistency finds every solution"""
+    a, b, c, d = variables(["a", "b", "c", "d"])
+    vs = [a, b, c, d]
+    domains = uniform_domains(vs, range(1, 25))
+    constraints = [
+        IsDivisibleBy(a, b),
+        AdditionCrosses10Boundary(b, c),
+        Equal(Add(a, c), d),
+    ]
+
+    bindings = list(
+        gen_bindings(
+            vs, domains, constraints, resume=True, unique=True, consistency=consistency
+        )
+    )
+
+    assert len(bindings) == n_solutions(vs, domains, constraints)
+    for binding in bindings:
+        assert all(constraint.is_satisfied(binding) for constraint in constraints)
+
+
+def test_backjumping_skips_innocent_variables():
+    """Test that a dead end jumps back past variables that didn't cause it"""
+    a, b, c = variables(["a", "b", "c"])
+    calls = []
+
+    class AreFar(Constraint):
+        def is_satisfied(self, bindings):
+            calls.append(bindings)
+            return abs(bindings[a] - bindings[c]) > 5
+
+        def variables(self):
+            return [a, c]
+
+    domains = {a: [1], b: list(range(2, 12)), c: [1, 2, 3]}
+    constraints = [IsLessThan(a, b), AreFar()]
+
+    assert list(gen_bindings([a, b, c], domains, constraints, resume=True)) == []
+    assert len(calls) == 30
+
+    calls.clear()
+    bindings = gen_bindings([a, b, c], domains, constraints, resume=True, backjump=True)
+    assert list(bindings) == []
+    assert len(calls) == 3
+
+
+@pytest.mark.parametrize("max_nogoods", [0, 2, 1000])
+def test_backjumping_finds_every_solution(max_nogoods):
+    """Test that backjumping and nogood learning lose no solutions"""
+    a, b, c, d, e = variables(["a", "b", "c", "d", "e"])
+    vs = [a, b, c, d, e]
+    domains = uniform_domains(vs, range(1, 10))
+    constraints = [
+        AdditionCrosses10Boundary(a, c),
+        IsDivisibleBy(Add(b, d), Lit(7)),
+        Equal(Subtract(e, a), Lit(2)),
+        IsLessThan(Multiply(c, d), Lit(20)),
+    ]
+
+    bindings = list(
+        gen_bindings(
+            vs,
+            domains,
+            constraints,
+            unique=True,
+            backjump=True,
+            max_nogoods=max_nogoods,
+        )
+    )
+
+    assert len(bindings) == n_solutions(vs, domains, constraints)
+    for binding in bindings:
+        assert all(constraint.is_satisfied(binding) for constraint in constraints)
+
+
+def test_find_conflict():
+    """Test that impossible templates are reported without searching"""
+    a, b, c, d, e = variables(["a", "b", "c", "d", "e"])
+    vs = [a, b, c, d, e]
+    domains = uniform_domains(vs, range(2, 100))
+    carry = AdditionCrosses10Boundary(a, b)
+    constraints = [
+        Equal(Add(Multiply(a, b), Multiply(c, d)), e),
+        IsDivisibleBy(a, Lit(10)),
+        carry,
+    ]
+
+    # a ends in 0, so adding it to b never carries
+    assert find_conflict(vs, domains, constraints) is carry
+    assert find_bindings(vs, domains, constraints) == []
+
+    assert find_conflict(vs, domains, constraints[:2]) is None
+    assert find_conflict(vs, domains, [IsLessThan(Lit(3), Lit(2))]) is not None
+
+    # The bounds of a and b only shrink by one per revision, so finding the
+    # conflict takes a revision per value
+    cycle = [IsLessThan(a, b), IsLessThan(b, a)]
+    large_domains = uniform_domains([a, b], range(10**4))
+    assert find_conflict([a, b], large_domains, cycle) is not None
+    assert find_bindings([a, b], large_domains, cycle) == []
+
+
+def test_node_budget():
+    """Test that max_nodes stops the search with the solutions found so far"""
+    a, b, c = variables(["a", "b", "c"])
+    vs = [a, b, c]
+    domains = uniform_domains(vs, range(1, 50))
+    constraints = [Equal(Add(a, b), c)]
+
+    with pytest.raises(SearchTimeout) as excinfo:
+        find_bindings(
+            vs, domains, constraints, n_bindings=100, resume=True, max_nodes=4
+        )
+
+    # Each solution costs a node for c, so the budget runs out early
+    assert 0 < len(excinfo.value.bindings) < 100
+    for binding in excinfo.value.bindings:
+        assert binding[a] + binding[b] == binding[c]
+
+
+def test_timeout():
+    """Test that a search that runs out of time stops with SearchTimeout"""
+    a, b = variables(["a", "b"])
+    domains = uniform_domains([a, b], range(1, 10))
+    constraints = [IsLessThan(a, b)]
+
+    with pytest.raises(SearchTimeout):
+        next(gen_bindings([a, b], domains, constraints, timeout=0))
+    assert latency_estimate([a, b], constraints) is not None
+
+    assert latency_estimate([a, b], [IsLessThan(b, a)]) is None
+
+
+def test_timeout_large_domain(monkeypatch):
+    """Test that a timeout stops a search that tries many values per node"""
+    a, b = variables(["a", "b"])
+    calls = []
+
+    # Every check takes a millisecond of the search's clock, so a timeout of
+    # 0.1 seconds runs out after 100 checks however fast the machine is
+    clock = types.SimpleNamespace(
+        monotonic=lambda: len(calls) / 1000, perf_counter=lambda: len(calls) / 1000
+    )
+    monkeypatch.setattr(diceomatic, "time", clock)
+
+    class Never(Constraint):
+        def is_satisfied(self, bindings):
+            calls.append(bindings)
+            return False
+
+        def variables(self):
+            return [a, b]
+
+    domains = uniform_domains([a, b], range(10**6))
+    for options in [{}, {"consistency": "arc"}, {"uniform": True}]:
+        calls.clear()
+        with pytest.raises(SearchTimeout):
+            find_bindings([a, b], domains, [Never()], timeout=0.1, **options)
+        # The first node has a million values to try
+        assert len(calls) < 1000
+
+
+def test_independent_groups_searched_once():
+    """Test that groups of variables that share no constraint are searched
+    separately instead of once per solution of the other group"""
+    a, b, c, d, e = variables(["a", "b", "c", "d", "e"])
+    vs = [a, b, c, d, e]
+    calls = []
+
+    class Differ(Constraint):
+        def is_satisfied(self, bindings):
+            calls.append(bindings)
+            return bindings[d] != bindings[e]
+
+        def variables(self):
+            return [d, e]
+
+    domains = uniform_domains(vs, range(1, 5))
+    constraints = [Equal(Add(a, b), c), Differ()]
+
+    bindings = list(gen_bindings(vs, domains, constraints, resume=True, unique=True))
+    solutions = {tuple(binding[v] for v in vs) for binding in bindings}
+
+    # 6 solutions of a + b = c times 12 pairs of different d and e
+    assert len(bindings) == len(solutions) == 72
+    assert len(calls) == 16
+
+
+def test_uniform_sampling_independent_groups():
+    """Test that independent groups are sampled separately and uniformly"""
+    a, b, c, d = variables(["a", "b", "c", "d"])
+    vs = [a, b, c, d]
+    domains = uniform_domains(vs, range(1, 4))
+    constraints = [IsLessThan(a, b), IsLessThan(c, d)]
+
+    random.seed(3)
+    counts = collections.Counter(
+        tuple(binding[v] for v in vs)
+        for binding in find_bindings(vs, domains, constraints, 900, uniform=True)
+    )
+
+    # 3 pairs with a < b times 3 pairs with c < d
+    assert len(counts) == 9
+    assert all(50 < count < 150 for count in counts.values())
+
+
+def test_independent_groups_with_zero():
+    """Test that groups are still solved separately when every variable can
+    be 0, leaving out only the all-zero combination"""
+    a, b, c, d = variables(["a", "b", "c", "d"])
+    vs = [a, b, c, d]
+    domains = uniform_domains(vs, range(0, 3))
+    constraints = [Equal(a, b), Equal(c, d)]
+
+    bindings = list(gen_bindings(vs, domains, constraints, resume=True, unique=True))
+    solutions = {tuple(binding[v] for v in vs) for binding in bindings}
+    assert len(bindings) == len(solutions) == 8
+    assert (0, 0, 0, 0) not in solutions
+
+    random.seed(4)
+    counts = collections.Counter(
+        tuple(binding[v] for v in vs)
+        for binding in find_bindings(vs, domains, constraints, 800, uniform=True)
+    )
+    assert len(counts) == 8
+    assert all(50 < count < 150 for count in counts.values())
+
+    # When the all-zero combination is the only one there is nothing to draw
+    zeros = uniform_domains(vs, [0])
+    assert find_bindings(vs, zeros, constraints, uniform=True) == []
+    assert find_bindings(vs, zeros, constraints, resume=True) == []
+
+
+def test_symmetry_breaking():
+    """Test that solutions that only swap interchangeable variables are
+    counted and generated once"""
+    a, b, c, d, e = variables(["a", "b", "c", "d", "e"])
+    vs = [a, b, c, d, e]
+    domains = uniform_domains(vs, range(2, 30))
+    constraints = [
+        AdditionCrosses10Boundary(Multiply(a, b), Multiply(c, d)),
+        IsLessThan(Multiply(a, b), Lit(20)),
+        Equal(Add(Multiply(a, b), Multiply(c, d)), e),
+    ]
+
+    # A*B < 20 tells A*B apart from C*D, so only the factors can be swapped
+    symmetries = compile_template(vs, constraints).symmetries(domains)
+    assert symmetries == [{a: b, b: a}, {c: d, d: c}]
+
+    every = find_bindings(vs, domains, constraints, 1000, resume=True, unique=True)
+    different = {
+        (min(s[a], s[b]), max(s[a], s[b]), min(s[c], s[d]), max(s[c], s[d]), s[e])
+        for s in every
+    }
+    assert n_solutions(vs, domains, constraints) == len(every)
+    assert n_solutions(vs, domains, constraints, break_symmetry=True) == len(different)
+
+    bindings = find_bindings(
+        vs, domains, constraints, 1000, resume=True, unique=True, break_symmetry=True
+    )
+    assert len(bindings) == len(different)
+    assert all(s[a] <= s[b] and s[c] <= s[d] for s in bindings)
+
+
+def test_symmetry_breaking_swaps_products():
+    """Test that whole products are swapped when nothing tells them apart"""
+    a, b, c, d, e = variables(["a", "b", "c", "d", "e"])
+    vs = [a, b, c, d, e]
+    domains = uniform_domains(vs, range(1, 8))
+    constraints = [Equal(Add(Multiply(a, b), Multiply(c, d)), e)]
+
+    symmetries = compile_template(vs, constraints).symmetries(domains)
+    assert {a: c, b: d, c: a, d: b} in symmetries
+
+    every = find_bindings(vs, domains, constraints, 1000, resume=True, unique=True)
+    different = {
+        tuple(sorted([tuple(sorted((s[a], s[b]))), tuple(sorted((s[c], s[d])))]))
+        + (s[e],)
+        for s in every
+    }
+    assert n_solutions(vs, domains, constraints, break_symmetry=True) == len(different)
+
+    # Variables with different domains are never swapped
+    domains[a] = list(range(1, 5))
+    symmetries = compile_template(vs, constraints).symmetries(domains)
+    assert symmetries == [{c: d, d: c}]
+
+
+def test_large_range_domains():
+    """Test that solving over ranges of a billion values doesn't list them"""
+    a, b, c = variables(["a", "b", "c"])
+    domains = uniform_domains([a, b, c], range(10**9))
+    constraints = [Equal(Add(a, b), c), IsDivisibleBy(a, Lit(7))]
+
+    bindings = find_bindings([a, b, c], domains, constraints, 20, max_nodes=10_000)
+    assert len(bindings) == 20
+    for binding in bindings:
+        assert binding[a] + binding[b] == binding[c]
+        assert binding[a] % 7 == 0
+
+    # The values are shuffled, not taken from the start of the range
+    assert max(binding[c] for binding in bindings) > 10**6
+
+    # Symmetry breaking narrows by the ranges' bounds too
+    constraints = [Equal(Add(a, b), c)]
+    bindings = find_bindings([a, b, c], domains, constraints, 5, break_symmetry=True)
+    assert all(binding[a] <= binding[b] for binding in bindings)
+
+
+def test_workers():
+    """Test generating solutions in worker processes"""
+    a, b, c = variables(["a", "b", "c"])
+    vs = [a, b, c]
+    domains = uniform_domains(vs, range(1, 20))
+    constraints = [Equal(Add(a, b), c), IsLessThan(a, b)]
+
+    bindings = find_bindings(vs, domains, constraints, 50, workers=2)
+    assert len(bindings) == 50
+    assert all(s[a] + s[b] == s[c] and s[a] < s[b] for s in bindings)
+
+    # Unique solutions stay unique across workers
+    bindings = find_bindings(
+        vs, domains, constraints, 1000, resume=True, unique=True, workers=2
+    )
+    solutions = {tuple(s[v] for v in vs) for s in bindings}
+    assert len(bindings) == len(solutions) == n_solutions(vs, domains, constraints)
+
+    # The parts of a's values each provide some of a few unique solutions
+    bindings = find_bindings(
+        vs,
+        uniform_domains(vs, range(200)),
+        [Equal(Add(a, b), c)],
+        12,
+        uniform=True,
+        unique=True,
+        workers=4,
+    )
+    assert len({s[a] % (4 * 4) for s in bindings}) > 1
+
+    # a = 0 holds 63 of the 70 solutions, so a uniform draw of 8 rarely takes
+    # more than a few from the parts with one solution each
+    random.seed(0)
+    bindings = find_bindings(
+        vs,
+        uniform_domains(vs, range(8)),
+        [IsLessThan(Multiply(a, Add(b, c)), Lit(1))],
+        8,
+        uniform=True,
+        unique=True,
+        workers=2,
+    )
+    assert len({tuple(s[v] for v in vs) for s in bindings}) == 8
+    assert sum(1 for s in bindings if s[a] != 0) <= 4
+
+    # Symmetries are broken on the whole domains, not on each worker's part
+    a, b, c, d, e = variables(["a", "b", "c", "d", "e"])
+    vs = [a, b, c, d, e]
+    domains = uniform_domains(vs, range(2, 12))
+    constraints = [Equal(Add(Multiply(a, b), Multiply(c, d)), e)]
+    expected = find_bindings(vs, domains, constraints, 100, unique=True)
+    bindings = find_bindings(
+        vs, domains, constraints, 100, unique=True, break_symmetry=True, workers=3
+    )
+    assert 0 < len(bindings) < len(expected)
+    assert len(bindings) == len(
+        find_bindings(vs, domains, constraints, 100, unique=True, break_symmetry=True)
+    )
+
+
+def test_shards():
+    """Test that shards cover the search space once and resume from a
+    saved cursor"""
+    a, b, c = variables(["a", "b", "c"])
+    vs = [a, b, c]
+    domains = uniform_domains(vs, range(0, 20))
+    constraints = [Equal(Add(a, b), c), IsDivisibleBy(c, Lit(3))]
+
+    shards = shard_search(vs, domains, 3)
+    assert len(shards) == 3
+    # c's values are sliced rather than giving every (a, b) pair a prefix
+    assert sum(shard.stop - shard.start for shard in shards) < 20 * 20
+    total = sum(count_shard(vs, domains, constraints, shard) for shard in shards)
+    assert total == n_solutions(vs, domains, constraints)
+
+    everything = []
+    for shard in shard_search(vs, domains, 3):
+        # Stop part way, save the cursor and resume from the saved copy
+        solutions = search_shard(vs, domains, constraints, shard)
+        everything.extend(itertools.islice(solutions, 5))
+        saved = json.dumps(dataclasses.asdict(shard))
+        resumed = Shard(**json.loads(saved))
+        everything.extend(search_shard(vs, domains, constraints, resumed))
+        assert resumed.done
+
+    solutions = [tuple(s[v] for v in vs) for s in everything]
+    assert len(solutions) == len(set(solutions)) == total
+
+
+def test_solve_portfolio():
+    """Test racing searches and repeating the winner from its config"""
+    a, b, c = variables(["a", "b", "c"])
+    vs = [a, b, c]
+    domains = uniform_domains(vs, range(1, 50))
+    constraints = [Equal(Multiply(a, b), c), IsDivisibleBy(c, Lit(7))]
+    configs = [{}, {"order": "mrv"}, {"backjump": True}]
+
+    solution, config = solve_portfolio(vs, domains, constraints, configs)
+    assert solution[a] * solution[b] == solution[c]
+    assert solution[c] % 7 == 0
+    options = {key: value for key, value in config.items() if key != "seed"}
+    assert options in configs
+
+    random.seed(config["seed"])
+    assert find_bindings(vs, domains, constraints, **options) == [solution]
+
+    # A search that proves there is no solution wins too
+    solution, _ = solve_portfolio(vs, domains, [IsLessThan(a, Lit(0))], configs)
+    assert solution is None
+
+    with pytest.raises(ValueError):
+        solve_portfolio(vs, domains, constraints, [])
+
+    class Crash(Constraint):
+        def is_satisfied(self, bindings):
+            os._exit(1)
+
+        def variables(self):
+            return [a]
+
+    # Processes that die without a result don't leave the caller waiting
+    with pytest.raises(RuntimeError):
+        solve_portfolio(vs, domains, [Crash()], configs)
+
+
+def test_agen_bindings():
+    """Test generating solutions without blocking the event loop"""
+    a, b, c = variables(["a", "b", "c"])
+    vs = [a, b, c]
+    domains = uniform_domains(vs, range(1, 10))
+    constraints = [Equal(Add(a, b), c)]
+
+    async def first(n):
+        bindings = []
+        async for binding in agen_bindings(vs, domains, constraints, unique=True):
+            bindings.append(binding)
+            if len(bindings) == n:
+                break
+        return bindings
+
+    bindings = asyncio.run(first(5))
+    assert len({tuple(s[v] for v in vs) for s in bindings}) == 5
+    assert all(s[a] + s[b] == s[c] for s in bindings)
+
+
+def test_agen_bindings_cancel():
+    """Test that cancelling the consuming task stops the search"""
+    a, b, c = variables(["a", "b", "c"])
+    calls = []
+    finished = []
+
+    class Never(Constraint):
+        def is_satisfied(self, bindings):
+            # Stop a search that ignored cancellation once the test is over,
+            # so that the test fails instead of waiting for it
+            if finished:
+                raise RuntimeError("The search outlived the test")
+            calls.append(bindings)
+            return False
+
+        def variables(self):
+            return [a, b, c]
+
+    domains = uniform_domains([a, b, c], range(1000))
+
+    async def cancel():
+        async def consume():
+            async for _ in agen_bindings([a, b, c], domains, [Never()]):
+                pass
+
+        async def started():
+            while not calls:
+                await asyncio.sleep(0.001)
+
+        # With a single executor thread, a call submitted after the search
+        # runs only once the search has stopped
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(1))
+        task = asyncio.create_task(consume())
+        try:
+            # The event loop keeps running while the search does
+            await asyncio.wait_for(started(), 10)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            n_calls = await asyncio.wait_for(loop.run_in_executor(None, len, calls), 10)
+            assert len(calls) == n_calls
+        finally:
+            finished.append(True)
+
+    asyncio.run(cancel())